@@ -0,0 +1,83 @@
+"""
+In-memory LRU cache of blocks.
+
+Block-device workloads re-read a small set of hot blocks (superblock,
+bitmaps, inode tables, directory blocks) over and over. BlockCache keeps
+recently read blocks in memory so those reads cost a dict lookup instead of
+a storage round-trip.
+
+Values are immutable bytes objects, so they can be handed out without
+copying; callers that need to modify a block take their own copy.
+"""
+
+from collections import OrderedDict
+from typing import Optional
+
+# Default cache budget: 64 MiB = 16384 blocks of 4 KiB.
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class BlockCache:
+    """
+    Least-recently-used cache of block_id -> bytes, bounded by total size.
+
+    An NbdServer serves a single export, so blocks are keyed by block_id.
+    """
+
+    def __init__(self, limit_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        """
+        Args:
+            limit_bytes: Maximum total size of cached blocks. 0 disables
+                         caching.
+        """
+        self.limit_bytes = limit_bytes
+        self._blocks: OrderedDict[int, bytes] = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def get(self, block_id: int) -> Optional[bytes]:
+        """
+        Return the cached block, marking it most recently used, or None.
+        """
+        data = self._blocks.get(block_id)
+        if data is not None:
+            self._blocks.move_to_end(block_id)
+        return data
+
+    def put(self, block_id: int, data: bytes) -> None:
+        """
+        Cache a block, evicting least recently used blocks to stay within
+        limit_bytes.
+        """
+        if len(data) > self.limit_bytes:
+            return
+
+        self.invalidate(block_id)
+        self._blocks[block_id] = data
+        self._size += len(data)
+
+        while self._size > self.limit_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._size -= len(evicted)
+
+    def invalidate_range(self, start: int, stop: int) -> None:
+        """
+        Drop blocks [start, stop) from the cache. Costs at most one step per
+        cached block, however long the range.
+        """
+        if stop - start > len(self._blocks):
+            block_ids = [b for b in self._blocks if start <= b < stop]
+        else:
+            block_ids = range(start, stop)
+        for block_id in block_ids:
+            self.invalidate(block_id)
+
+    def invalidate(self, block_id: int) -> None:
+        """
+        Drop a block from the cache, if present.
+        """
+        data = self._blocks.pop(block_id, None)
+        if data is not None:
+            self._size -= len(data)
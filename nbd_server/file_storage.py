@@ -1,46 +1,171 @@
+import errno
+import mmap
 import os
+import threading
+from typing import Optional
 
 from nbd_server.storage import Storage
-from nbd_server.util import BLOCK_SIZE
+from nbd_server.util import BLOCK_MASK, BLOCK_SHIFT, BLOCK_SIZE, ZERO_BLOCK
+
+# os.fdatasync is not available on every platform (e.g. macOS).
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+# os.pwritev is not available on every platform (e.g. macOS < 11); there
+# write_blocks() falls back to one pwrite() per block.
+_HAS_PWRITEV = hasattr(os, "pwritev")
+
+# Maximum number of buffers per pwritev() call (IOV_MAX on Linux and BSD).
+_IOV_MAX = 1024
+
+# mmap.madvise / MADV_RANDOM are not available on every platform.
+_MADV_RANDOM = getattr(mmap, "MADV_RANDOM", None) if hasattr(mmap.mmap, "madvise") else None
+
+
+def _reserve(fd: int, size: int) -> bool:
+    """
+    Allocate disk space for the first `size` bytes of a file. Returns False
+    if the space cannot be reserved (disk full, or unsupported).
+
+    A store into a MAP_SHARED mapping that has to allocate a hole on a full
+    disk raises SIGBUS, which kills the process, where pwrite() would have
+    failed with a catchable ENOSPC. So a backing file is only mapped once
+    its whole image is allocated.
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        return False
+    return True
+
 
 # This class represents File storage.
 class FileStorage(Storage):
     """
     Local filesystem-backed block storage.
 
-    Blocks are stored under:
-        data/exports/<export_name>/blocks/<block_id>
+    Each export is stored in a single sparse backing file:
+        data/exports/<export_name>/blocks.img
+
+    Block <block_id> lives at byte offset block_id * BLOCK_SIZE. Blocks are
+    read and written with os.pread()/os.pwrite() on a file descriptor that
+    is opened once per export and cached, so a block access is one syscall
+    (no per-block open/stat/close/rename).
+
+    Each block is exactly BLOCK_SIZE bytes. Unwritten blocks are holes in
+    the sparse file (or lie past its end) and read as zero-filled blocks,
+    consistent with block device semantics.
 
-    Each block is exactly BLOCK_SIZE bytes. Missing blocks are treated
-    as zero-filled blocks, consistent with block device semantics.
+    With reserve=True and a known device size (total_size_bytes), disk
+    space for the whole image is reserved (posix_fallocate) and the backing
+    file is mmap()ed (MAP_SHARED): blocks are then copied to and from the
+    mapping without a syscall, and get_view() exposes the whole image so a
+    byte range can be sliced out directly. This gives up sparseness: the
+    image takes its full size on disk. By default, or if the space cannot
+    be reserved, the file stays sparse and pread()/pwrite() are used; they
+    report a full disk as OSError(ENOSPC) rather than SIGBUS.
 
     This backend is simple, durable, and easy to test locally.
     """
 
-    def __init__(self, base_path: str = "data"):
+    def __init__(
+        self,
+        base_path: str = "data",
+        total_size_bytes: Optional[int] = None,
+        reserve: bool = False,
+    ):
         """
         Args:
             base_path: Root directory where exports/ will live.
+            total_size_bytes: Optional device size. When given, each backing
+                              file is extended to this size when it is
+                              opened.
+            reserve: Allocate disk space for the whole device when a backing
+                     file is opened, and map it into memory. Requires
+                     total_size_bytes.
         """
         self.base_path = base_path
+        self.total_size_bytes = total_size_bytes
+        self.reserve = reserve
 
-    def _block_path(self, export_name: str, block_id: int) -> str:
+        # export_name -> open file descriptor of its backing file.
+        self._fds: dict[str, int] = {}
+        self._fds_lock = threading.Lock()
+        # export_name -> mmap of the first total_size_bytes of its file.
+        self._mms: dict[str, mmap.mmap] = {}
+        # Exports known to have no backing file yet, so reads and
+        # get_view() do not stat the path on every call until one is
+        # created.
+        self._absent: set[str] = set()
+
+    def _backing_path(self, export_name: str) -> str:
         """
-        Returns the full filesystem path for a given block file.
+        Returns the full filesystem path of an export's backing file.
         """
         return os.path.join(
             self.base_path,
             "exports",
             export_name,
-            "blocks",
-            str(block_id),
+            "blocks.img",
         )
 
+    def _fd(self, export_name: str, create: bool) -> Optional[int]:
+        """
+        Return the cached fd for an export's backing file, opening it on
+        first use.
+
+        If the file does not exist and create is False, returns None.
+        """
+        fd = self._fds.get(export_name)
+        if fd is not None:
+            return fd
+        if not create and export_name in self._absent:
+            return None
+
+        with self._fds_lock:
+            fd = self._fds.get(export_name)
+            if fd is not None:
+                return fd
+
+            path = self._backing_path(export_name)
+            if not create and not os.path.exists(path):
+                self._absent.add(export_name)
+                return None
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            if (
+                    self.total_size_bytes is not None
+                    and os.fstat(fd).st_size < self.total_size_bytes
+            ):
+                os.ftruncate(fd, self.total_size_bytes)
+
+            if (
+                    self.reserve
+                    and self.total_size_bytes
+                    and _reserve(fd, self.total_size_bytes)
+            ):
+                mm = mmap.mmap(fd, self.total_size_bytes)
+                # NBD traffic is random block I/O (sequential streams are
+                # prefetched by NbdServer): turn off kernel readahead on
+                # page faults, which would mostly fault in unused pages.
+                if _MADV_RANDOM is not None:
+                    mm.madvise(_MADV_RANDOM)
+                self._mms[export_name] = mm
+
+            self._fds[export_name] = fd
+            self._absent.discard(export_name)
+            return fd
+
     def read_block(self, export_name: str, block_id: int) -> bytes:
         """
         Read exactly one block from the local filesystem.
 
-        If the file does not exist, return a zero-filled block.
+        If the backing file does not exist, or the block lies (partly) past
+        its end, the missing bytes read as zeros.
 
         Note: Only *full* block reads are performed here.
         Partial reads (from offset,length) are handled in nbd_backend.py,
@@ -55,23 +180,26 @@ class FileStorage(Storage):
             For each block_id in [first_block_id, last_block_id]:
                 read_block(export, block_id)
         """
-        path = self._block_path(export_name, block_id)
+        fd = self._fd(export_name, create=False)
 
-        # Block not written yet → zero-filled block
-        if not os.path.exists(path):
-            return bytes(BLOCK_SIZE)
+        # Export not written yet → zero-filled block
+        if fd is None:
+            return ZERO_BLOCK
 
-        with open(path, "rb") as f:
-            data = f.read()
+        pos = block_id << BLOCK_SHIFT
+        mm = self._mms.get(export_name)
+        if mm is not None and pos + BLOCK_SIZE <= len(mm):
+            return mm[pos:pos + BLOCK_SIZE]
 
-        # Normalize block size
-        if len(data) != BLOCK_SIZE:
-            if len(data) < BLOCK_SIZE:
-                # pad short blocks (shouldn't happen in practice)
-                data = data + bytes(BLOCK_SIZE - len(data))
-            else:
-                # truncate oversized blocks (shouldn't happen)
-                data = data[:BLOCK_SIZE]
+        data = os.pread(fd, BLOCK_SIZE, pos)
+
+        # Block past the end of the backing file → zero-filled block
+        if not data:
+            return ZERO_BLOCK
+
+        # Short read ending inside the block → pad with zeros
+        if len(data) < BLOCK_SIZE:
+            data = data.ljust(BLOCK_SIZE, b"\0")
 
         return data
 
@@ -79,8 +207,9 @@ class FileStorage(Storage):
         """
         Write exactly one block to the filesystem.
 
-        Ensures directories exist and overwrites the block file atomically.
-        Atomic write = write to <path>.tmp → rename to <path>.
+        The block is written in place, into the mapping or with a single
+        os.pwrite(). No fsync is issued here; the page cache decides when the
+        data reaches disk.
 
         NOTE:
         Partial-block writes are handled by nbd_backend.py. That layer:
@@ -93,13 +222,193 @@ class FileStorage(Storage):
                 f"Block data must be exactly {BLOCK_SIZE} bytes; got {len(data)} bytes"
             )
 
-        path = self._block_path(export_name, block_id)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = self._fd(export_name, create=True)
+        pos = block_id << BLOCK_SHIFT
+        mm = self._mms.get(export_name)
+        if mm is not None and pos + BLOCK_SIZE <= len(mm):
+            mm[pos:pos + BLOCK_SIZE] = data
+        else:
+            os.pwrite(fd, data, pos)
+
+    def write_blocks(self, export_name: str, items: list[tuple[int, bytes]]) -> None:
+        """
+        Write several blocks, in items order.
+
+        Blocks inside the mapping are copied into it directly. Elsewhere,
+        each run of consecutive block ids is written with a single
+        os.pwritev() of the callers' buffers (no joining copy), instead of
+        one os.pwrite() per block.
+        """
+        for _, data in items:
+            if len(data) != BLOCK_SIZE:
+                raise ValueError(
+                    f"Block data must be exactly {BLOCK_SIZE} bytes; got {len(data)} bytes"
+                )
+
+        fd = self._fd(export_name, create=True)
+        mm = self._mms.get(export_name)
+        mapped = len(mm) if mm is not None else 0
 
-        temp_path = f"{path}.tmp"
+        i = 0
+        while i < len(items):
+            start = items[i][0]
+            pos = start << BLOCK_SHIFT
+            if pos + BLOCK_SIZE <= mapped:
+                mm[pos:pos + BLOCK_SIZE] = items[i][1]
+                i += 1
+                continue
 
-        # Write atomically
-        with open(temp_path, "wb") as f:
-            f.write(data)
+            j = i + 1
+            while (
+                    j < len(items)
+                    and j - i < _IOV_MAX
+                    and items[j][0] == start + (j - i)
+            ):
+                j += 1
+            buffers = [data for _, data in items[i:j]]
 
-        os.replace(temp_path, path)
\ No newline at end of file
+            if _HAS_PWRITEV:
+                written = os.pwritev(fd, buffers, pos)
+            else:
+                written = 0
+            if written < (j - i) << BLOCK_SHIFT:
+                # Short (or no) vectored write: finish the rest with pwrite,
+                # which either completes it or raises the error (e.g. ENOSPC).
+                rest = memoryview(b"".join(buffers))[written:]
+                while rest:
+                    n = os.pwrite(fd, rest, pos + written)
+                    written += n
+                    rest = rest[n:]
+            i = j
+
+    def get_view(self, export_name: str) -> Optional[memoryview]:
+        """
+        Return a writable memoryview of the export's mapped image, or None
+        if it is not mapped (device size unknown, or nothing written yet).
+
+        The view aliases the page cache: it observes later writes, and must
+        not be kept beyond the request that obtained it.
+        """
+        if not self.reserve or self._fd(export_name, create=False) is None:
+            return None
+        mm = self._mms.get(export_name)
+        return memoryview(mm) if mm is not None else None
+
+    def read_blocks(self, export_name: str, block_ids: list[int]) -> list[bytes]:
+        """
+        Read several blocks, in block_ids order.
+
+        Each run of consecutive block ids is read with a single os.pread()
+        and split into blocks, so a multi-block read costs one syscall per
+        contiguous run instead of one per block.
+        """
+        fd = self._fd(export_name, create=False)
+
+        # Export not written yet → zero-filled blocks
+        if fd is None:
+            return [ZERO_BLOCK] * len(block_ids)
+
+        mm = self._mms.get(export_name)
+        mapped = len(mm) if mm is not None else 0
+
+        blocks = []
+        i = 0
+        while i < len(block_ids):
+            start = block_ids[i]
+            j = i + 1
+            while j < len(block_ids) and block_ids[j] == start + (j - i):
+                j += 1
+            run_bytes = (j - i) << BLOCK_SHIFT
+            pos = start << BLOCK_SHIFT
+
+            if pos + run_bytes <= mapped:
+                data = mm[pos:pos + run_bytes]
+            else:
+                data = os.pread(fd, run_bytes, pos)
+            if len(data) < run_bytes:
+                # The file ends inside the run: pad up to the end of the
+                # block it ends in; blocks after that are ZERO_BLOCK.
+                data = data.ljust((len(data) + BLOCK_MASK) & ~BLOCK_MASK, b"\0")
+
+            if len(data) == BLOCK_SIZE and j - i == 1:
+                blocks.append(data)
+            else:
+                blocks.extend(
+                    data[k:k + BLOCK_SIZE] if k < len(data) else ZERO_BLOCK
+                    for k in range(0, run_bytes, BLOCK_SIZE)
+                )
+            i = j
+
+        return blocks
+
+    def list_blocks(self, export_name: str):
+        """
+        List the blocks backed by allocated extents of the sparse file.
+
+        Uses lseek(SEEK_DATA / SEEK_HOLE) to walk the data extents; holes
+        read as zeros and are skipped. Returns None where SEEK_DATA is not
+        supported. Space reserved (reserve=True) but never written is
+        reported as a hole by most filesystems (ext4, XFS). Filesystems
+        that report it, or a whole non-sparse file, as data are merely
+        conservative.
+        """
+        fd = self._fd(export_name, create=False)
+        if fd is None:
+            return []
+        if not hasattr(os, "SEEK_DATA"):
+            return None
+
+        block_ids = []
+        size = os.fstat(fd).st_size
+        pos = 0
+        while pos < size:
+            try:
+                data_start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # no data after pos
+                    break
+                raise
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+
+            block_ids.extend(range(
+                data_start >> BLOCK_SHIFT,
+                (data_end + BLOCK_MASK) >> BLOCK_SHIFT,
+            ))
+            pos = data_end
+
+        return block_ids
+
+    def flush(self, export_name: str) -> None:
+        """
+        Make all blocks written so far durable with one fdatasync() of the
+        export's backing file (group commit), instead of syncing per block.
+
+        fdatasync skips the inode metadata update that fsync also forces;
+        platforms without it (e.g. macOS) fall back to fsync. Blocks written
+        through the mapping are first written back with mmap.flush()
+        (msync), which POSIX requires for shared mappings.
+        """
+        fd = self._fd(export_name, create=False)
+        if fd is None:
+            return
+
+        mm = self._mms.get(export_name)
+        if mm is not None:
+            mm.flush()
+        _fdatasync(fd)
+
+    def close(self) -> None:
+        """
+        Unmap and close every cached backing file. Exports are re-opened on
+        next use, so close() is safe to call more than once.
+
+        Views returned by get_view() must have been released first.
+        """
+        with self._fds_lock:
+            for mm in self._mms.values():
+                mm.close()
+            for fd in self._fds.values():
+                os.close(fd)
+            self._mms.clear()
+            self._fds.clear()
+            self._absent.clear()
@@ -11,16 +11,50 @@ Key responsibilities:
 - Perform multi-block reads and writes.
 - Perform read-modify-write (RMW) for partial-block writes.
 - Delegate full-block persistence to the Storage layer.
-
-For now, this backend uses FileStorage only. S3Storage can be added later
-and selected via configuration.
+- Read-through: blocks not yet resident in volatile storage are fetched
+  from non-volatile storage, with readahead for sequential streams.
 """
 
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from nbd_server.cache import DEFAULT_CACHE_BYTES, BlockCache
+from nbd_server.prefetch import PrefetchingReader
 from nbd_server.util import (
+    BLOCK_MASK,
+    BLOCK_SHIFT,
     BLOCK_SIZE,
-    blocks_touched,
+    ZERO_BLOCK,
+    BlockBitmap,
+    BufferPool,
 )
 
+# Scratch blocks for read-modify-write (see NbdServer.write).
+_buffers = BufferPool()
+
+# Number of recent read end-offsets remembered for sequential detection.
+# A read that starts where one of these ended continues a sequential stream;
+# keeping a few lets interleaved streams (e.g. two readers) each be detected.
+SEQUENTIAL_HISTORY = 4
+
+# Blocks loaded by reads of more than CACHE_MAX_READ_BLOCKS blocks (64 KiB),
+# or by reads continuing a sequential stream, are not added to the LRU
+# cache: bulk scans would otherwise evict the hot set.
+CACHE_MAX_READ_BLOCKS = 16
+
+# flush() moves dirty blocks in batches of FLUSH_BATCH_BLOCKS dirty blocks
+# (256 blocks = 1 MiB), extended to the end of the non-volatile storage's
+# write_unit() (e.g. S3 pack_size) so a batch never splits a stripe. Up to
+# FLUSH_QUEUE_DEPTH batches are copied concurrently.
+FLUSH_BATCH_BLOCKS = 256
+FLUSH_QUEUE_DEPTH = 4
+
+# close() waits at most LISTER_JOIN_TIMEOUT seconds for the block-listing
+# thread. A thread started before a fork() is dead in the child but still
+# reports is_alive(), so an untimed join would never return.
+LISTER_JOIN_TIMEOUT = 5.0
+
 
 class NbdServer:
     """
@@ -32,6 +66,14 @@ class NbdServer:
 
     It operates on a single export (export_name) and uses a Storage
     implementation (currently FileStorage) for persistence.
+
+    When non-volatile storage is configured, volatile storage acts as a
+    read-through cache of it: a block is read from non-volatile storage the
+    first time it is touched and then copied into volatile storage.
+
+    Recently read (or partially written) blocks are additionally kept in an
+    in-memory LRU cache (BlockCache), so hot blocks are served without
+    touching storage.
     """
 
     def __init__(
@@ -40,6 +82,8 @@ class NbdServer:
             total_size_bytes: int,
             volatile_storage = None,
             nonvolatile_storage = None,
+            prefetch_blocks: int = 64,
+            cache_limit_bytes: int = DEFAULT_CACHE_BYTES,
     ) -> None:
         """
         Args:
@@ -49,16 +93,65 @@ class NbdServer:
                               get_size() will return this value.
             volatile_storage: FileStorage Storage object representing volatile storage.
             nonvolatile_storage: S3Storage object representing non-volatile storage.
+            prefetch_blocks: Number of blocks to read ahead from non-volatile
+                             storage once a sequential read stream is
+                             detected. 0 disables readahead.
+            cache_limit_bytes: Size of the in-memory LRU block cache.
+                               0 disables the cache.
         """
         self.export_name = export_name
         self.total_size_bytes = total_size_bytes
         self.volatile_storage = volatile_storage
         self.nonvolatile_storage = nonvolatile_storage
-        # Tracks blocks modified since last flush. A set is used instead of a list
-        # because multiple writes may target the same block. Using a set ensures
-        # each block_id appears only once, preventing redundant writes to durable
-        # storage during flush() and matching expected write‑back cache semantics.
-        self.dirty_blocks = set()
+        self._num_blocks = (total_size_bytes + BLOCK_MASK) >> BLOCK_SHIFT
+
+        # Tracks blocks modified since last flush, as a BlockBitmap: 1 bit per
+        # block of the device rather than ~28 bytes per int in a set. Multiple
+        # writes to the same block set the same bit, so flush() writes each
+        # block to durable storage only once (write-back cache semantics), and
+        # iteration yields the dirty blocks in ascending order.
+        self.dirty_blocks = BlockBitmap(self._num_blocks)
+
+        # Read-through state. Only used when non-volatile storage exists;
+        # without it, volatile storage is the only copy and is read directly.
+        # _resident_blocks holds the block_ids whose current contents are in
+        # volatile storage. _lock serializes updates to it (and the matching
+        # volatile write) between request handling and prefetch threads.
+        self._lock = threading.Lock()
+        self._resident_blocks = BlockBitmap(self._num_blocks)
+        self._recent_read_ends = deque(maxlen=SEQUENTIAL_HISTORY)
+
+        # Blocks that may hold non-zero data ("ever written"). Writes are
+        # recorded here from the start; the blocks already stored in the
+        # authoritative storage (non-volatile if configured, else volatile)
+        # are listed by a background thread (see start_listing()), so a long
+        # listing never stalls a request. Until it has been merged in,
+        # _written_blocks() returns None and nothing is assumed about
+        # unlisted blocks. Afterwards, a block outside this bitmap is known
+        # to be all zeros, so reading it (e.g. the read half of a
+        # read-modify-write) can be skipped. Updated under _lock.
+        self._written = BlockBitmap(self._num_blocks)
+        self._written_ready = threading.Event()
+
+        # In-memory LRU of recently read blocks. Entries are invalidated
+        # whenever the block is written.
+        self._cache = BlockCache(cache_limit_bytes)
+
+        self._reader = None
+        if nonvolatile_storage is not None:
+            self._reader = PrefetchingReader(
+                nonvolatile_storage,
+                export_name,
+                install=self._install_block,
+                window=prefetch_blocks,
+            )
+
+        # The listing thread is started by start_listing(), not here: the
+        # nbdkit plugin builds NbdServer before nbdkit forks, and threads do
+        # not survive a fork. close() sets _closing and joins the thread
+        # before closing the storages it lists.
+        self._closing = threading.Event()
+        self._lister = None
 
     # ---------------------------------------------------------------------
     # Public API: these are the methods your NBD server / nbdkit plugin
@@ -71,16 +164,37 @@ class NbdServer:
         """
         return self.total_size_bytes
 
+    def start_listing(self) -> None:
+        """
+        Start the background thread that lists the blocks already stored
+        (see _list_written_blocks()). Idempotent; the first read() or
+        write() calls it, so callers only need it to start the listing
+        earlier (e.g. the nbdkit plugin's after_fork()).
+        """
+        with self._lock:
+            if self._lister is not None or self._closing.is_set():
+                return
+            self._lister = threading.Thread(
+                target=self._list_written_blocks, name="nbd-list-blocks", daemon=True,
+            )
+            self._lister.start()
+
     def read(self, offset: int, length: int) -> bytes:
         """
         Read exactly `length` bytes starting at `offset` from the virtual
         block device.
 
-        This may touch one or more blocks. For each block_id in the range,
-        we:
-            - read the FULL block via storage.read_block()
-            - slice the portion we need
-            - append it to the result
+        If volatile storage exposes its image (Storage.get_view()) and holds
+        every block of the range, the bytes are sliced out of it directly.
+        Otherwise all blocks in the range are fetched in one batch (see
+        _read_blocks(): resident blocks come from volatile storage, the rest
+        from non-volatile storage). Only the first and last blocks can be
+        partial; every block in between is used whole. The result is
+        assembled with a single b"".join() over the blocks (first/last
+        trimmed via zero-copy memoryview slices): one allocation and one
+        copy per byte, with the per-block loop running in C rather than
+        Python bytecode. If every block is the shared ZERO_BLOCK (never
+        written), the zeros are returned without copying.
 
         Returns:
             A bytes object of length `length`.
@@ -88,115 +202,183 @@ class NbdServer:
         if self.volatile_storage is None:
             raise RuntimeError("No storage backend configured for NbdServer")
 
+        if self._lister is None:
+            self.start_listing()
+
         if length == 0:
             return b""
 
-        if offset < 0 or offset + length > self.total_size_bytes:
-            raise ValueError("read range is out of bounds of the device size")
-
-        result = bytearray()
+        # One chained comparison: rejects offset < 0, length < 0 and ranges
+        # past the end of the device.
         end = offset + length
+        if not 0 <= offset <= end <= self.total_size_bytes:
+            raise ValueError("read range is out of bounds of the device size")
 
-        for block_id in blocks_touched(offset, length):
-            block = self.volatile_storage.read_block(self.export_name, block_id)
-
-            block_start = block_id * BLOCK_SIZE
-            block_end = block_start + BLOCK_SIZE
-
-            # Compute intersection of [offset, end) with [block_start, block_end)
-            local_start = max(offset, block_start) - block_start
-            local_end = min(end, block_end) - block_start
-
-            if local_start < 0 or local_end < 0 or local_start > BLOCK_SIZE:
-                # Should not happen; defensive check.
-                continue
-
-            result.extend(block[local_start:local_end])
-
-        # Defensive check: we should have constructed exactly `length` bytes.
+        # Blocks touched: [first_block, last_block] (see util.blocks_touched).
+        first_block = offset >> BLOCK_SHIFT
+        last_block = (end - 1) >> BLOCK_SHIFT
+
+        # Sequential stream: keep the next prefetch_blocks blocks in flight
+        # before fetching this request's own misses.
+        sequential = False
+        if self._reader is not None and self._reader.window > 0:
+            sequential = offset in self._recent_read_ends
+            if sequential:
+                self._prefetch_after(last_block)
+            self._recent_read_ends.append(end)
+
+        # Fast path: volatile storage holds every block of the range and can
+        # expose its image, so slice the bytes out in one copy.
+        view = self._volatile_view(first_block, last_block)
+        if view is not None:
+            return view[offset:end].tobytes()
+
+        block_ids = list(range(first_block, last_block + 1))
+        blocks = self._read_blocks(
+            block_ids,
+            populate_cache=not sequential and len(block_ids) <= CACHE_MAX_READ_BLOCKS,
+        )
+
+        # Sparse range: nothing to copy. bytes(n) is allocated pre-zeroed.
+        if all(block is ZERO_BLOCK for block in blocks):
+            return bytes(length)
+
+        # Offsets of the requested range inside the first and last block.
+        head = offset & BLOCK_MASK
+        tail = ((end - 1) & BLOCK_MASK) + 1
+
+        if len(blocks) == 1:
+            result = bytes(memoryview(blocks[0])[head:tail])
+        else:
+            parts = list(blocks)
+            parts[0] = memoryview(blocks[0])[head:]
+            parts[-1] = memoryview(blocks[-1])[:tail]
+            result = b"".join(parts)
+
+        # Defensive check: we should have assembled exactly `length` bytes.
         if len(result) != length:
             raise RuntimeError(
                 f"read(): expected {length} bytes, assembled {len(result)} bytes"
             )
 
-        return bytes(result)
+        return result
 
     def write(self, offset: int, data: bytes) -> None:
         """
         Write the contents of `data` starting at `offset` on the virtual
         block device.
 
-        This may touch one or more blocks. For each block_id in the range,
-        we determine whether the write:
-            - fully covers the block (fast path)
-            - partially covers the block (needs read-modify-write)
+        The range is split into at most three parts:
+            - a partial first block (needs read-modify-write)
+            - the whole blocks in between (fast path)
+            - a partial last block (needs read-modify-write)
+
+        Whole blocks are copied into a mapped volatile image with a single
+        slice assignment, or else passed as zero-copy memoryview slices of
+        `data` to a single write_blocks() call (one pwritev() per run for
+        FileStorage).
 
         Partial-block writes:
-            1. Read existing block via storage.read_block()
+            1. Read existing block via storage.read_block() (skipped for
+               blocks known never to have been written: they are zeros)
             2. Modify only the overlapping slice
             3. Write back the full block via storage.write_block()
         """
         if self.volatile_storage is None:
             raise RuntimeError("No storage backend configured for NbdServer")
 
+        if self._lister is None:
+            self.start_listing()
+
         length = len(data)
         if length == 0:
             return
 
-        if offset < 0 or offset + length > self.total_size_bytes:
+        end = offset + length
+        if not 0 <= offset < end <= self.total_size_bytes:
             raise ValueError("write range is out of bounds of the device size")
 
-        end = offset + length
+        # Slicing a memoryview does not copy; slices of `data` below are
+        # copied exactly once, into their destination block.
+        src = memoryview(data)
+
+        # [aligned_start, aligned_end) is the run of whole blocks; it is
+        # empty if the write does not cover any block fully.
+        aligned_start = min((offset + BLOCK_MASK) & ~BLOCK_MASK, end)
+        aligned_end = max(end & ~BLOCK_MASK, aligned_start)
+
+        if offset < aligned_start:
+            self._write_partial_block(offset, src[:aligned_start - offset])
+        if aligned_start < aligned_end:
+            self._write_aligned(
+                aligned_start, src[aligned_start - offset:aligned_end - offset]
+            )
+        if aligned_end < end:
+            self._write_partial_block(aligned_end, src[aligned_end - offset:])
 
-        for block_id in blocks_touched(offset, length):
-            block_start = block_id * BLOCK_SIZE
-            block_end = block_start + BLOCK_SIZE
-
-            # Intersection of [offset, end) with [block_start, block_end)
-            write_start_in_block = max(offset, block_start) - block_start
-            write_end_in_block = min(end, block_end) - block_start
-            bytes_to_write_in_block = write_end_in_block - write_start_in_block
-
-            # Corresponding slice in the input `data`
-            # Global index in data where this block's slice begins:
-            src_start = max(block_start, offset) - offset
-            src_end = src_start + bytes_to_write_in_block
-
-            # Sanity checks
-            if not (0 <= write_start_in_block <= BLOCK_SIZE):
-                continue
-            if bytes_to_write_in_block <= 0:
-                continue
-
-            # Fast path: this write fully covers the block
-            if write_start_in_block == 0 and bytes_to_write_in_block == BLOCK_SIZE:
-                # We can write this block directly from `data` slice.
-                new_block = data[src_start:src_end]
-                if len(new_block) != BLOCK_SIZE:
-                    raise RuntimeError(
-                        f"Expected full-block slice of {BLOCK_SIZE} bytes, "
-                        f"got {len(new_block)} bytes"
-                    )
-                self.volatile_storage.write_block(self.export_name, block_id, new_block)
+    def _write_aligned(self, offset: int, src: memoryview) -> None:
+        """
+        Write whole blocks: offset and len(src) are multiples of BLOCK_SIZE.
+
+        No intersection math or read-modify-write is needed. If volatile
+        storage exposes its image, the whole run is stored into it with one
+        slice assignment; otherwise every block is a zero-copy slice of src,
+        and all of them go to volatile storage in one write_blocks() call.
+        Either way the block bitmaps and the cache are updated per run, not
+        per block.
+
+        Cached copies are dropped rather than replaced (unlike
+        _write_volatile()), so bulk sequential writes do not flush hot
+        blocks out of the cache.
+        """
+        first_block = offset >> BLOCK_SHIFT
+        stop = first_block + (len(src) >> BLOCK_SHIFT)
+        view = self.volatile_storage.get_view(self.export_name)
+
+        with self._lock:
+            if view is not None:
+                view[offset:offset + len(src)] = src
             else:
-                # Partial-block write → read-modify-write
-                existing_block = bytearray(
-                    self.volatile_storage.read_block(self.export_name, block_id)
-                )
-                existing_block[
-                write_start_in_block:write_end_in_block
-                ] = data[src_start:src_end]
-
-                if len(existing_block) != BLOCK_SIZE:
-                    raise RuntimeError(
-                        f"Existing block must remain {BLOCK_SIZE} bytes; "
-                        f"got {len(existing_block)} bytes"
-                    )
-
-                self.volatile_storage.write_block(
-                    self.export_name, block_id, bytes(existing_block)
-                )
+                self.volatile_storage.write_blocks(self.export_name, [
+                    (first_block + i, src[pos:pos + BLOCK_SIZE])
+                    for i, pos in enumerate(range(0, len(src), BLOCK_SIZE))
+                ])
+            self._resident_blocks.add_range(first_block, stop)
+            self._written.add_range(first_block, stop)
+
+        self._cache.invalidate_range(first_block, stop)
+        self.dirty_blocks.add_range(first_block, stop)
+
+    def _write_partial_block(self, offset: int, src: memoryview) -> None:
+        """
+        Write src, which lies within a single block.
+
+        If volatile storage exposes its image and holds the block, src is
+        stored into it in place. Otherwise the block is updated by
+        read-modify-write in a pooled scratch buffer (storage does not keep
+        a reference to it).
+        """
+        block_id = offset >> BLOCK_SHIFT
+        if self._splice_volatile(block_id, offset, src):
             self.dirty_blocks.add(block_id)
+            return
+
+        start = offset & BLOCK_MASK
+        written = self._written_blocks()
+
+        existing_block = _buffers.acquire()
+        try:
+            if written is not None and block_id not in written:
+                # Never written: the existing block is all zeros.
+                existing_block[:] = ZERO_BLOCK
+            else:
+                existing_block[:] = self._read_blocks([block_id])[0]
+            existing_block[start:start + len(src)] = src
+
+            self._write_volatile(block_id, existing_block)
+        finally:
+            _buffers.release(existing_block)
+        self.dirty_blocks.add(block_id)
 
     def flush(self) -> None:
         """
@@ -206,12 +388,297 @@ class NbdServer:
         - All completed writes prior to flush() are made durable.
         - Each dirty block is flushed exactly once.
         - After a successful flush, the dirty block set is cleared.
+
+        Dirty blocks are read and written in batches (read_blocks /
+        write_blocks) so that S3 requests are issued concurrently. They are
+        passed in block order, so contiguous runs stay adjacent: storages
+        that pack blocks (S3Storage with pack_size) or issue vectored I/O
+        can coalesce each run into a single request.
+
+        Up to FLUSH_QUEUE_DEPTH batches are copied concurrently (see
+        _copy_dirty_blocks()), so scattered dirty blocks do not cost one
+        S3 round trip after another.
+
+        Each storage is synced once per flush (storage.flush()), rather than
+        once per block: volatile storage first, so the local copy matches
+        what is about to be made durable, then non-volatile storage after
+        all dirty blocks have been written to it. Blocks are marked clean
+        only after that final sync succeeds; if flush() fails, every block
+        stays dirty and is written again by the next flush().
         """
         if self.nonvolatile_storage is None:
             raise RuntimeError("Flush called but no non-volatile storage configured.")
 
-        for block_id in self.dirty_blocks:
-            block_bytes = self.volatile_storage.read_block(self.export_name, block_id)
-            self.nonvolatile_storage.write_block(self.export_name, block_id, block_bytes)
+        if not self.dirty_blocks:
+            return
+
+        self.volatile_storage.flush(self.export_name)
+
+        block_ids = list(self.dirty_blocks)  # ascending
+        self._copy_dirty_blocks(block_ids)
+        self.nonvolatile_storage.flush(self.export_name)
+
+        self.dirty_blocks.difference_update(block_ids)
+
+    def close(self) -> None:
+        """
+        Stop the background block listing, wait for background prefetches
+        and close both storage backends.
+
+        close() does not flush: call flush() first to make dirty blocks
+        durable.
+        """
+        with self._lock:
+            self._closing.set()
+        if self._lister is not None:
+            self._lister.join(timeout=LISTER_JOIN_TIMEOUT)
+        if self._reader is not None:
+            self._reader.close()
+        if self.volatile_storage is not None:
+            self.volatile_storage.close()
+        if self.nonvolatile_storage is not None:
+            self.nonvolatile_storage.close()
+
+    def _copy_dirty_blocks(self, block_ids: list[int]) -> None:
+        """
+        Copy block_ids (sorted) from volatile to non-volatile storage.
+
+        Blocks are grouped into batches of FLUSH_BATCH_BLOCKS dirty blocks;
+        a full batch is only cut where the next block starts a new
+        write_unit(), so a batch never splits a stripe. Each batch is read
+        and uploaded by one of FLUSH_QUEUE_DEPTH worker threads, so uploads
+        of different batches overlap. Returns once every batch is uploaded;
+        re-raises the first error, after cancelling the batches not yet
+        started.
+        """
+        unit = self.nonvolatile_storage.write_unit()
+
+        batches: list[list[int]] = []
+        for block_id in block_ids:
+            if batches and (
+                len(batches[-1]) < FLUSH_BATCH_BLOCKS
+                or batches[-1][-1] // unit == block_id // unit
+            ):
+                batches[-1].append(block_id)
+            else:
+                batches.append([block_id])
+
+        def copy(batch):
+            blocks = self.volatile_storage.read_blocks(self.export_name, batch)
+            self.nonvolatile_storage.write_blocks(
+                self.export_name, list(zip(batch, blocks))
+            )
+
+        # Nothing to overlap: skip the thread pool.
+        if len(batches) == 1:
+            copy(batches[0])
+            return
+
+        pool = ThreadPoolExecutor(max_workers=FLUSH_QUEUE_DEPTH, thread_name_prefix="nbd-flush")
+        try:
+            for future in [pool.submit(copy, batch) for batch in batches]:
+                future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # ---------------------------------------------------------------------
+    # Read-through helpers
+    # ---------------------------------------------------------------------
+
+    def _read_blocks(self, block_ids: list[int], populate_cache: bool = True) -> list[bytes]:
+        """
+        Return the current contents of block_ids, in order.
+
+        Blocks in the LRU cache are served from memory; the rest are loaded
+        with _load_blocks() and, if populate_cache is set, added to the
+        cache. ZERO_BLOCK results (never-written blocks) are never cached:
+        they cost nothing to return again, but would use up the budget.
+        """
+        cache = self._cache
+        if cache.limit_bytes == 0:
+            return self._load_blocks(block_ids)
+
+        blocks = [cache.get(b) for b in block_ids]
+        missing = [b for b, data in zip(block_ids, blocks) if data is None]
+        if not missing:
+            return blocks
+
+        loaded = dict(zip(missing, self._load_blocks(missing)))
+        if populate_cache:
+            for block_id, data in loaded.items():
+                if data is not ZERO_BLOCK:
+                    cache.put(block_id, data)
+
+        return [
+            data if data is not None else loaded[b]
+            for b, data in zip(block_ids, blocks)
+        ]
+
+    def _load_blocks(self, block_ids: list[int]) -> list[bytes]:
+        """
+        Load the current contents of block_ids from storage, in order.
+
+        Resident blocks come from volatile storage. The rest are fetched
+        from non-volatile storage and installed into volatile storage.
+        """
+        if self._reader is None:
+            return self.volatile_storage.read_blocks(self.export_name, block_ids)
+
+        with self._lock:
+            missing = [b for b in block_ids if b not in self._resident_blocks]
+
+        if not missing:
+            return self.volatile_storage.read_blocks(self.export_name, block_ids)
+
+        # Blocks never written anywhere are zeros; don't fetch them.
+        written = self._written_blocks()
+        fetched = {}
+        if written is not None:
+            for b in missing:
+                if b not in written:
+                    fetched[b] = ZERO_BLOCK
+            missing = [b for b in missing if b not in fetched]
+
+        if missing:
+            for block_id, data in zip(missing, self._reader.fetch(missing)):
+                fetched[block_id] = data
+                self._install_block(block_id, data)
+
+        resident = [b for b in block_ids if b not in fetched]
+        local = dict(zip(
+            resident,
+            self.volatile_storage.read_blocks(self.export_name, resident),
+        ))
+
+        return [
+            fetched[b] if b in fetched else local[b]
+            for b in block_ids
+        ]
+
+    def _volatile_view(self, first_block: int, last_block: int):
+        """
+        Return volatile storage's image view (see Storage.get_view()) if it
+        has one and every block in [first_block, last_block] is current in
+        it, else None.
+        """
+        view = self.volatile_storage.get_view(self.export_name)
+        if view is None or self._reader is None:
+            return view
+
+        with self._lock:
+            if not self._resident_blocks.contains_range(first_block, last_block + 1):
+                return None
+        return view
+
+    def _write_volatile(self, block_id: int, data: bytes) -> None:
+        """
+        Write a full block to volatile storage and mark it resident (and
+        written).
+
+        The new contents also replace the block's entry in the LRU cache
+        (write-through): blocks updated by partial writes, e.g. metadata,
+        tend to be rewritten soon, and the next read-modify-write of the
+        block is then served from memory.
+        """
+        with self._lock:
+            self.volatile_storage.write_block(self.export_name, block_id, data)
+            self._resident_blocks.add(block_id)
+            self._written.add(block_id)
+        if self._cache.limit_bytes:
+            self._cache.put(block_id, bytes(data))
+
+    def _splice_volatile(self, block_id: int, offset: int, src: memoryview) -> bool:
+        """
+        Store src at device offset `offset` (inside block_id) directly into
+        volatile storage's image view, if it has one and holds the current
+        contents of the block. Returns False if the caller must fall back
+        to read-modify-write.
+        """
+        view = self.volatile_storage.get_view(self.export_name)
+        if view is None:
+            return False
+
+        with self._lock:
+            if self._reader is not None and block_id not in self._resident_blocks:
+                return False
+            view[offset:offset + len(src)] = src
+            self._written.add(block_id)
+
+        if self._cache.limit_bytes:
+            block_start = block_id << BLOCK_SHIFT
+            self._cache.put(block_id, view[block_start:block_start + BLOCK_SIZE].tobytes())
+        return True
+
+    def _written_blocks(self):
+        """
+        Return the "ever written" BlockBitmap, or None while the background
+        listing is still running (or if the storage cannot list its blocks).
+        Never blocks.
+        """
+        if self._written_ready.is_set():
+            return self._written
+        return None
+
+    def _list_written_blocks(self) -> None:
+        """
+        Background thread: merge the authoritative storage's list_blocks()
+        into _written and mark it ready. Stops early once close() is called.
+
+        Blocks written while the listing runs are already recorded in
+        _written, so none are missed. If the storage cannot list its blocks,
+        or listing fails, _written never becomes ready.
+        """
+        source = self.nonvolatile_storage
+        if source is None:
+            source = self.volatile_storage
+        if source is None:
+            return
+
+        stored = BlockBitmap(self._num_blocks)
+        try:
+            listed = source.list_blocks(self.export_name)
+            if listed is None:
+                return
+            # Checked per listed block: S3Storage.list_blocks() yields as it
+            # pages, so close() does not wait for the rest of the listing.
+            for block_id in listed:
+                if self._closing.is_set():
+                    return
+                if 0 <= block_id < self._num_blocks:
+                    stored.add(block_id)
+        except Exception:
+            return
+
+        with self._lock:
+            self._written.union_update(stored)
+        self._written_ready.set()
+
+    def _install_block(self, block_id: int, data: bytes) -> None:
+        """
+        Copy a block fetched from non-volatile storage into volatile storage,
+        unless a newer version has been written there in the meantime.
+        """
+        with self._lock:
+            if block_id in self._resident_blocks:
+                return
+            self.volatile_storage.write_block(self.export_name, block_id, data)
+            self._resident_blocks.add(block_id)
+
+    def _prefetch_after(self, last_block: int) -> None:
+        """
+        Schedule readahead of the non-resident blocks following last_block.
+        """
+        first = last_block + 1
+        stop = min(first + self._reader.window, self._num_blocks)
+
+        written = self._written_blocks()
+
+        with self._lock:
+            candidates = [
+                b for b in range(first, stop)
+                if b not in self._resident_blocks
+                and (written is None or b in written)
+            ]
 
-        self.dirty_blocks.clear()
\ No newline at end of file
+        if candidates:
+            self._reader.prefetch(candidates)
@@ -13,7 +13,20 @@ This module is loaded by nbdkit when invoked with:
         bucket=nbdbucket \
         s3_endpoint=http://localhost:9000 \
         s3_access_key=minioadmin \
-        s3_secret_key=minioadmin
+        s3_secret_key=minioadmin \
+        s3_pack_size=256 \
+        s3_max_workers=32 \
+        s3_compress=false \
+        volatile_reserve=false
+
+s3_pack_size is optional; when set, S3 objects pack that many blocks each.
+s3_max_workers (optional, default 32, at most 64: the size of the S3
+connection pool) is the number of concurrent S3 requests used to read and
+flush batches of blocks. s3_compress (optional,
+default false) LZ4-compresses per-block objects and needs the lz4 package;
+it cannot be combined with s3_pack_size. volatile_reserve
+(optional, default false) allocates the whole local image up front so it
+can be memory-mapped, instead of keeping it sparse.
 
 The plugin wires nbdkit's pread/pwrite/flush operations to an NbdServer
 instance backed by a volatile (FileStorage) and a non-volatile (S3Storage)
@@ -24,7 +37,7 @@ import nbdkit  # Provided by nbdkit at runtime, may appear unresolved in IDE.
 
 from nbd_server.nbd_server import NbdServer
 from nbd_server.file_storage import FileStorage
-from nbd_server.s3_storage import S3Storage
+from nbd_server.s3_storage import MAX_POOL_CONNECTIONS, S3Storage
 
 
 # ---------------------------------------------------------------------------
@@ -34,11 +47,15 @@ from nbd_server.s3_storage import S3Storage
 _export_name: str | None = None
 _total_size_bytes: int | None = None
 _volatile_path: str | None = None
+_volatile_reserve: bool = False
 
 _s3_bucket: str | None = None
 _s3_endpoint: str = "http://localhost:9000"
 _s3_access_key: str = "minioadmin"
 _s3_secret_key: str = "minioadmin"
+_s3_pack_size: int | None = None
+_s3_max_workers: int = 32
+_s3_compress: bool = False
 
 # Global NbdServer instance. Created once in config_complete().
 _server: NbdServer | None = None
@@ -59,6 +76,18 @@ class Handle:
 # nbdkit plugin entrypoints
 # ---------------------------------------------------------------------------
 
+def _parse_bool(key: str, value: str) -> bool:
+    """
+    Parse a boolean parameter value (true/false, yes/no, on/off, 1/0).
+    """
+    lowered = value.lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off"):
+        return False
+    raise nbdkit.Error(f"Invalid boolean parameter: {key}={value}")
+
+
 def config(key: str, value: str) -> None:
     """
     Called by nbdkit for each configuration parameter.
@@ -67,8 +96,9 @@ def config(key: str, value: str) -> None:
         nbdkit python nbdkit_plugin.py export=dev1 size=1048576 \
             volatile_path=data/exports bucket=nbdbucket
     """
-    global _export_name, _total_size_bytes, _volatile_path
+    global _export_name, _total_size_bytes, _volatile_path, _volatile_reserve
     global _s3_bucket, _s3_endpoint, _s3_access_key, _s3_secret_key
+    global _s3_pack_size, _s3_max_workers, _s3_compress
 
     if key == "export":
         _export_name = value
@@ -76,6 +106,8 @@ def config(key: str, value: str) -> None:
         _total_size_bytes = int(value)
     elif key == "volatile_path":
         _volatile_path = value
+    elif key == "volatile_reserve":
+        _volatile_reserve = _parse_bool(key, value)
     elif key == "bucket":
         _s3_bucket = value
     elif key == "s3_endpoint":
@@ -84,6 +116,16 @@ def config(key: str, value: str) -> None:
         _s3_access_key = value
     elif key == "s3_secret_key":
         _s3_secret_key = value
+    elif key == "s3_pack_size":
+        _s3_pack_size = int(value)
+    elif key == "s3_max_workers":
+        _s3_max_workers = int(value)
+        if not 0 < _s3_max_workers <= MAX_POOL_CONNECTIONS:
+            raise nbdkit.Error(
+                f"s3_max_workers must be between 1 and {MAX_POOL_CONNECTIONS}; got {value}"
+            )
+    elif key == "s3_compress":
+        _s3_compress = _parse_bool(key, value)
     else:
         # nbdkit.Error will cause nbdkit to fail fast with a useful message.
         raise nbdkit.Error(f"Unknown parameter: {key}={value}")
@@ -109,15 +151,25 @@ def config_complete() -> None:
     nbdkit.debug(f"nbdkit_plugin: export={_export_name}, "
                  f"size={_total_size_bytes}, "
                  f"volatile_path={_volatile_path}, "
-                 f"bucket={_s3_bucket}, endpoint={_s3_endpoint}")
+                 f"volatile_reserve={_volatile_reserve}, "
+                 f"bucket={_s3_bucket}, endpoint={_s3_endpoint}, "
+                 f"pack_size={_s3_pack_size}, max_workers={_s3_max_workers}, "
+                 f"compress={_s3_compress}")
 
-    volatile_storage = FileStorage(_volatile_path)
+    volatile_storage = FileStorage(
+        _volatile_path,
+        total_size_bytes=_total_size_bytes,
+        reserve=_volatile_reserve,
+    )
     nonvolatile_storage = S3Storage(
         bucket=_s3_bucket,
         export_name=_export_name,
         endpoint_url=_s3_endpoint,
         aws_access_key_id=_s3_access_key,
         aws_secret_access_key=_s3_secret_key,
+        max_workers=_s3_max_workers,
+        pack_size=_s3_pack_size,
+        compress=_s3_compress,
     )
 
     _server = NbdServer(
@@ -130,6 +182,18 @@ def config_complete() -> None:
     nbdkit.debug("nbdkit_plugin: NbdServer created successfully")
 
 
+def after_fork() -> None:
+    """
+    Called once nbdkit has forked into the background.
+
+    Threads do not survive the fork, so the NbdServer created in
+    config_complete() starts its background block listing here. Where
+    nbdkit does not call after_fork(), the first request starts it.
+    """
+    if _server is not None:
+        _server.start_listing()
+
+
 def open(readonly: bool):
     """
     Called for each new client connection.
@@ -182,8 +246,33 @@ def flush(h: Handle) -> None:
 def close(h: Handle) -> None:
     """
     Called when a client connection is closed.
+
+    Flushes the connection's outstanding writes to S3. Volatile storage
+    does not remember which blocks are dirty across restarts, so a client
+    that disconnects without NBD_CMD_FLUSH would otherwise lose them if
+    nbdkit then exits.
     """
     nbdkit.debug("nbdkit_plugin: close()")
-    # No per-connection resources to release; NbdServer lives for the life of
-    # the nbdkit process.
-    return
+    h.server.flush()
+
+
+def cleanup() -> None:
+    """
+    Called once when nbdkit shuts down, after the last connection closed.
+
+    Flushes writes that were never followed by a flush or a clean close(),
+    then closes the backing files and thread pools. This runs while the
+    interpreter is fully alive; an atexit handler would run after
+    concurrent.futures has shut down, so the flush could not schedule its
+    uploads.
+    """
+    global _server
+    if _server is None:
+        return
+
+    nbdkit.debug("nbdkit_plugin: cleanup()")
+    try:
+        _server.flush()
+    finally:
+        _server.close()
+        _server = None
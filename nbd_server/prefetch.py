@@ -0,0 +1,140 @@
+"""
+Read-through fetching and sequential readahead from non-volatile storage.
+
+NbdServer serves reads from volatile storage (FileStorage). A block that is
+not resident there yet (e.g. after a restart with an empty volatile
+directory) has to be fetched from non-volatile storage (S3) first, which
+costs a full S3 round-trip.
+
+PrefetchingReader wraps the non-volatile storage and:
+- fetch(): reads missing blocks synchronously, re-using any background
+  prefetch already in flight for them instead of issuing a second GET.
+- prefetch(): schedules background reads of blocks ahead of a sequential
+  stream. Each fetched block is handed to an `install` callback, which
+  copies it into volatile storage so later reads are local.
+
+Deciding *when* to prefetch (sequential detection) is left to NbdServer,
+which sees the stream of read offsets.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from nbd_server.storage import Storage
+
+
+class PrefetchingReader:
+    """
+    Read-through helper over a non-volatile Storage backend.
+    """
+
+    def __init__(
+            self,
+            source: Storage,
+            export_name: str,
+            install: Callable[[int, bytes], None],
+            window: int = 64,
+            max_workers: int = 4,
+    ) -> None:
+        """
+        Args:
+            source: Non-volatile storage blocks are fetched from.
+            export_name: Export whose blocks are fetched.
+            install: Called as install(block_id, data) from a background
+                     thread for every prefetched block.
+            window: Number of blocks to read ahead of a sequential stream.
+                    0 disables readahead (fetch() still works).
+            max_workers: Number of background prefetch threads.
+        """
+        self.source = source
+        self.export_name = export_name
+        self.window = window
+        self._install = install
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # block_id -> Future[bytes] for prefetches not yet completed.
+        self._lock = threading.Lock()
+        self._inflight: dict[int, Future] = {}
+
+    def fetch(self, block_ids: list[int]) -> list[bytes]:
+        """
+        Read blocks from the source storage, in block_ids order.
+
+        Blocks with a prefetch in flight are waited on rather than re-read;
+        if that prefetch failed, the block is read again here.
+        """
+        with self._lock:
+            pending = {
+                block_id: self._inflight[block_id]
+                for block_id in block_ids
+                if block_id in self._inflight
+            }
+
+        fetched: dict[int, bytes] = {}
+        for block_id, future in pending.items():
+            try:
+                fetched[block_id] = future.result()
+            except Exception:
+                pass
+
+        missing = [block_id for block_id in block_ids if block_id not in fetched]
+        if missing:
+            blocks = self.source.read_blocks(self.export_name, missing)
+            fetched.update(zip(missing, blocks))
+
+        return [fetched[block_id] for block_id in block_ids]
+
+    def prefetch(self, block_ids: list[int]) -> None:
+        """
+        Schedule a background read of block_ids. Blocks that already have a
+        prefetch in flight are skipped. Returns immediately.
+        """
+        with self._lock:
+            batch = [block_id for block_id in block_ids if block_id not in self._inflight]
+            futures = {block_id: Future() for block_id in batch}
+            self._inflight.update(futures)
+
+        if batch:
+            self._executor.submit(self._run_prefetch, futures)
+
+    def wait(self) -> None:
+        """
+        Block until every prefetch scheduled so far has completed.
+        """
+        with self._lock:
+            futures = list(self._inflight.values())
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        """
+        Stop accepting prefetches and wait for the running ones to finish.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run_prefetch(self, futures: dict[int, Future]) -> None:
+        """
+        Background task: read one prefetch batch and install every block.
+        """
+        block_ids = list(futures)
+        try:
+            blocks = self.source.read_blocks(self.export_name, block_ids)
+            for block_id, data in zip(block_ids, blocks):
+                self._install(block_id, data)
+        except Exception as e:
+            # Prefetch is best-effort; fetch() retries failed blocks itself.
+            for future in futures.values():
+                future.set_exception(e)
+        else:
+            for block_id, data in zip(block_ids, blocks):
+                futures[block_id].set_result(data)
+        finally:
+            with self._lock:
+                for block_id, future in futures.items():
+                    if self._inflight.get(block_id) is future:
+                        del self._inflight[block_id]
@@ -1,10 +1,113 @@
-from typing import Optional
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+try:
+    # botocore can only compute CRC32C checksums with the awscrt extension
+    # (pip install "botocore[crt]").
+    import awscrt  # noqa: F401
+except ImportError:
+    awscrt = None
+
+try:
+    # Optional LZ4 compression of per-block objects (pip install lz4).
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
 from nbd_server.storage import Storage
-from nbd_server.util import BLOCK_SIZE
+from nbd_server.util import BLOCK_SIZE, ZERO_BLOCK
+
+# Size of each client's HTTP connection pool. Must be at least the number of
+# concurrent requests (S3Storage max_workers), or requests queue for a
+# connection and new connections are opened and torn down under load.
+MAX_POOL_CONNECTIONS = 64
+
+# Objects of at least MULTIPART_THRESHOLD bytes (large packed stripes) are
+# uploaded with multipart upload in MULTIPART_PART_SIZE parts. S3 requires
+# every part but the last to be at least 5 MiB.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_PART_SIZE = 5 * 1024 * 1024
+
+# Parts of one multipart upload, and MULTIPART_PART_SIZE sub-ranges of one
+# large ranged GET, are transferred up to MULTIPART_CONCURRENCY at a time.
+MULTIPART_CONCURRENCY = 8
+
+_CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    signature_version="s3v4",
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+
+# Extra put_object / multipart upload arguments: with awscrt, ask for a
+# CRC32C checksum, which awscrt computes in hardware-accelerated C. Without
+# it, botocore's default checksum is used.
+_PUT_CHECKSUM_ARGS = {"ChecksumAlgorithm": "CRC32C"} if awscrt is not None else {}
+
+# User metadata of a block object whose body is LZ4-compressed (lz4.block
+# format, without the size header: blocks are always BLOCK_SIZE bytes).
+_LZ4_METADATA = {"compressed": "lz4"}
+
+# boto3 clients, keyed by (endpoint_url, region, access_key, secret_key).
+# Shared by all S3Storage instances (i.e. all exports) with the same
+# connection settings, so they also share warm keep-alive connections.
+_CLIENTS: dict[tuple, object] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _fit(data: bytes, length: int) -> bytes:
+    """
+    Pad data with zeros, or truncate it, to exactly `length` bytes.
+
+    Objects written by S3Storage always have the expected size, so the
+    common path is a single length comparison. Short or oversized objects
+    (written by other tools) are still normalized rather than trusted.
+    """
+    if len(data) == length:
+        return data
+    if len(data) < length:
+        return data.ljust(length, b"\0")
+    return data[:length]
+
+
+def _decompress(data: bytes) -> bytes:
+    """
+    Decompress the body of a block object stored with _LZ4_METADATA.
+    """
+    if lz4_block is None:
+        raise RuntimeError("S3 object is LZ4-compressed; install the lz4 package to read it")
+    return lz4_block.decompress(data, uncompressed_size=BLOCK_SIZE)
+
+
+def _get_client(
+        endpoint_url: Optional[str],
+        region: str,
+        aws_access_key_id: Optional[str],
+        aws_secret_access_key: Optional[str],
+):
+    """
+    Return the shared boto3 S3 client for these settings, creating it once.
+    """
+    key = (endpoint_url, region, aws_access_key_id, aws_secret_access_key)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name=region,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                config=_CLIENT_CONFIG,
+            )
+            _CLIENTS[key] = client
+        return client
 
 
 class S3Storage(Storage):
@@ -14,7 +117,23 @@ class S3Storage(Storage):
     Blocks are stored under:
         exports/<export_name>/blocks/<block_id>
 
-    Missing blocks return zero-filled bytes(BLOCK_SIZE).
+    or, when pack_size is set, packed pack_size blocks per object under:
+        exports/<export_name>/stripes/<stripe_id>
+    where stripe_id = block_id // pack_size.
+
+    Missing blocks return the shared zero-filled ZERO_BLOCK.
+
+    With compress=True (requires the lz4 package), per-block objects are
+    LZ4-compressed when that makes them smaller (mostly-zero blocks shrink
+    to a few dozen bytes) and marked with `compressed: lz4` user metadata;
+    other blocks are stored raw. Packed stripes are always raw, so ranged
+    GETs can address blocks.
+
+    With one object per block, a request spanning N blocks costs N S3
+    round-trips; read_blocks()/write_blocks() issue those requests
+    concurrently from a thread pool instead of one after another. With
+    packed stripes, a contiguous run of blocks inside one stripe is fetched
+    with a single ranged GET (see read_range()).
     """
 
     def __init__(
@@ -25,6 +144,9 @@ class S3Storage(Storage):
             region: str = "us-east-1",
             aws_access_key_id: Optional[str] = None,
             aws_secret_access_key: Optional[str] = None,
+            max_workers: int = 32,
+            pack_size: Optional[int] = None,
+            compress: bool = False,
     ) -> None:
         """
         Args:
@@ -33,18 +155,51 @@ class S3Storage(Storage):
             endpoint_url: Optional MinIO URL (e.g., http://localhost:9000)
             region: AWS region (ignored for MinIO).
             aws_access_key_id / aws_secret_access_key: credentials.
+            max_workers: Maximum number of concurrent S3 requests issued by
+                         read_blocks() / write_blocks(). At most
+                         MAX_POOL_CONNECTIONS, so every request gets a
+                         pooled connection.
+            pack_size: Optional number of blocks packed into one S3 object
+                       (e.g. 256 blocks = 1 MiB). None stores one object per
+                       block.
+            compress: Compress per-block objects with LZ4. Requires the
+                      lz4 package; not supported with pack_size.
         """
+        if not 0 < max_workers <= MAX_POOL_CONNECTIONS:
+            raise ValueError(
+                f"max_workers must be between 1 and {MAX_POOL_CONNECTIONS}; got {max_workers}"
+            )
+        if pack_size is not None and pack_size <= 0:
+            raise ValueError(f"pack_size must be positive; got {pack_size}")
+        if compress and pack_size is not None:
+            raise ValueError("compress is not supported with pack_size")
+        if compress and lz4_block is None:
+            raise RuntimeError("compress requires the lz4 package (pip install lz4)")
+
         self.bucket = bucket
         self.export_name = export_name
+        self.pack_size = pack_size
+        self.compress = compress
+
+        # Key prefixes, built once so per-block keys are a concatenation.
+        self._key_prefix = sys.intern(f"exports/{export_name}/blocks/")
+        self._stripe_prefix = sys.intern(f"exports/{export_name}/stripes/")
 
-        self.s3 = boto3.client(
-            "s3",
-            endpoint_url=endpoint_url,
-            region_name=region,
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
+        self.s3 = _get_client(
+            endpoint_url,
+            region,
+            aws_access_key_id,
+            aws_secret_access_key,
         )
 
+        # boto3 clients are thread-safe, so all workers share self.s3.
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # Parts of large objects get their own pool: they are submitted from
+        # _executor workers (one per stripe), and waiting on the same pool
+        # could deadlock once every worker is waiting for its parts.
+        self._part_executor = ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY)
+
     # ------------------------
     # Internal helpers
     # ------------------------
@@ -53,13 +208,155 @@ class S3Storage(Storage):
         """
         S3 key for this block.
         """
-        return f"exports/{self.export_name}/blocks/{block_id}"
+        return self._key_prefix + str(block_id)
 
-    def _key_tmp(self, block_id: int) -> str:
+    def _stripe_key(self, stripe_id: int) -> str:
         """
-        Temporary key used for atomic write.
+        S3 key for a packed stripe of pack_size blocks.
         """
-        return f"exports/{self.export_name}/blocks/{block_id}.tmp"
+        return self._stripe_prefix + str(stripe_id)
+
+    def _put(self, key: str, body: bytes, metadata: Optional[dict] = None) -> None:
+        """
+        Upload body to key with a single PUT.
+
+        S3 PUTs are atomic per object: readers see either the old or the new
+        object in full, never a partial write. So no temporary key, copy or
+        delete is needed. Version history, if wanted, is a matter of enabling
+        bucket versioning.
+        """
+        if isinstance(body, memoryview):
+            body = bytes(body)  # botocore accepts bytes/bytearray, not memoryview
+
+        extra_args = dict(_PUT_CHECKSUM_ARGS)
+        if metadata:
+            extra_args["Metadata"] = metadata
+
+        if len(body) >= MULTIPART_THRESHOLD:
+            self._put_multipart(key, body, extra_args)
+            return
+
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=body,
+            ContentLength=len(body),
+            **extra_args,
+        )
+
+    def _put_multipart(self, key: str, body: bytes, extra_args: dict) -> None:
+        """
+        Upload a large object as a multipart upload of MULTIPART_PART_SIZE
+        parts. Like a single PUT, the object only becomes visible once the
+        upload completes; a failed upload is aborted.
+
+        Parts are uploaded concurrently (up to MULTIPART_CONCURRENCY at a
+        time). With awscrt, every part carries a CRC32C checksum, which S3
+        verifies and combines into a checksum of the whole object.
+
+        extra_args (checksum algorithm, user metadata) apply to the whole
+        object, as with put_object.
+        """
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket, Key=key, **extra_args,
+        )["UploadId"]
+
+        def upload_part(part_number: int) -> dict:
+            start = (part_number - 1) * MULTIPART_PART_SIZE
+            resp = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body[start:start + MULTIPART_PART_SIZE],
+                **_PUT_CHECKSUM_ARGS,
+            )
+            part = {"ETag": resp["ETag"], "PartNumber": part_number}
+            if "ChecksumCRC32C" in resp:
+                part["ChecksumCRC32C"] = resp["ChecksumCRC32C"]
+            return part
+
+        num_parts = -(-len(body) // MULTIPART_PART_SIZE)
+        try:
+            # Parts are listed in part_number order, as S3 requires.
+            parts = list(self._part_executor.map(upload_part, range(1, num_parts + 1)))
+
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+            )
+            raise
+
+    def _get_range(self, key: str, start: int, length: int) -> bytes:
+        """
+        Fetch [start, start + length) of an object with a ranged GET.
+
+        Ranges of at least MULTIPART_THRESHOLD bytes are split into
+        MULTIPART_PART_SIZE sub-ranges fetched concurrently, since a single
+        connection delivers far less than S3's aggregate throughput.
+
+        Missing objects, and ranges past the end of a short object, read as
+        zeros; the result is always exactly `length` bytes.
+        """
+        if length < MULTIPART_THRESHOLD:
+            return self._get_subrange(key, start, length)
+
+        offsets = range(start, start + length, MULTIPART_PART_SIZE)
+        chunks = self._part_executor.map(
+            lambda offset: self._get_subrange(
+                key, offset, min(MULTIPART_PART_SIZE, start + length - offset)
+            ),
+            offsets,
+        )
+        return b"".join(chunks)
+
+    def _get_subrange(self, key: str, start: int, length: int) -> bytes:
+        """
+        _get_range() with a single ranged GET.
+        """
+        try:
+            resp = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                Range=f"bytes={start}-{start + length - 1}",
+            )
+            data = resp["Body"].read()
+        except ClientError as e:
+            err = e.response["Error"]["Code"]
+            if err in ("NoSuchKey", "404", "InvalidRange", "416"):
+                return bytes(length)  # zero-fill
+            raise
+
+        return _fit(data, length)
+
+    def _write_stripe(self, stripe_id: int, blocks: dict[int, bytes]) -> None:
+        """
+        Write the given blocks (block_id -> data) into one packed stripe.
+
+        If the blocks do not cover the whole stripe, the existing stripe is
+        fetched first and the new blocks are spliced into it. Concurrent
+        writers to the same stripe are not supported.
+        """
+        stripe_bytes = self.pack_size * BLOCK_SIZE
+        first_block = stripe_id * self.pack_size
+        key = self._stripe_key(stripe_id)
+
+        if len(blocks) == self.pack_size:
+            stripe = bytearray(stripe_bytes)
+        else:
+            stripe = bytearray(self._get_range(key, 0, stripe_bytes))
+
+        for block_id, data in blocks.items():
+            start = (block_id - first_block) * BLOCK_SIZE
+            stripe[start:start + BLOCK_SIZE] = data
+
+        self._put(key, bytes(stripe))
 
     # ------------------------
     # Storage API
@@ -69,6 +366,9 @@ class S3Storage(Storage):
         """
         Read a block from S3. Missing object → return zero-filled block.
         """
+        if self.pack_size is not None:
+            return self.read_range(export_name, block_id, block_id)[0]
+
         key = self._key(block_id)
 
         try:
@@ -77,43 +377,184 @@ class S3Storage(Storage):
         except ClientError as e:
             err = e.response["Error"]["Code"]
             if err in ("NoSuchKey", "404"):
-                return bytes(BLOCK_SIZE)  # zero-fill
+                return ZERO_BLOCK  # zero-fill
             raise
 
-        # Normalize to BLOCK_SIZE
-        if len(data) < BLOCK_SIZE:
-            data = data + bytes(BLOCK_SIZE - len(data))
-        elif len(data) > BLOCK_SIZE:
-            data = data[:BLOCK_SIZE]
+        if resp.get("Metadata", {}).get("compressed") == "lz4":
+            data = _decompress(data)
 
-        return data
+        return _fit(data, BLOCK_SIZE)
 
     def write_block(self, export_name: str, block_id: int, data: bytes) -> None:
         """
-        Write a full block to S3 atomically.
-        Upload to a temporary key, then overwrite the final key.
+        Write a full block to S3 atomically, with a single PUT (of the
+        LZ4-compressed block, if compression is on and it shrinks the block).
+        With pack_size set, this is a read-modify-write of the whole stripe;
+        prefer write_blocks() to update many blocks of a stripe at once.
         """
         if len(data) != BLOCK_SIZE:
             raise ValueError(
                 f"data must be exactly {BLOCK_SIZE} bytes; got {len(data)} bytes"
             )
 
-        key = self._key(block_id)
-        tmp_key = self._key_tmp(block_id)
+        if self.pack_size is not None:
+            self._write_stripe(block_id // self.pack_size, {block_id: data})
+            return
 
-        # Upload to temporary object
-        self.s3.put_object(
-            Bucket=self.bucket,
-            Key=tmp_key,
-            Body=data,
+        if self.compress:
+            compressed = lz4_block.compress(data, store_size=False)
+            if len(compressed) < len(data):
+                self._put(self._key(block_id), compressed, _LZ4_METADATA)
+                return
+
+        self._put(self._key(block_id), data)
+
+    def read_range(self, export_name: str, first_block: int, last_block: int) -> list[bytes]:
+        """
+        Read the contiguous blocks [first_block, last_block] of one stripe
+        with a single ranged GET. Requires pack_size.
+
+        Returns:
+            A list of BLOCK_SIZE bytes objects, one per block in the range.
+        """
+        if self.pack_size is None:
+            raise RuntimeError("read_range() requires a packed layout (pack_size)")
+
+        stripe_id = first_block // self.pack_size
+        if last_block < first_block or last_block // self.pack_size != stripe_id:
+            raise ValueError(
+                f"blocks {first_block}..{last_block} do not lie within one stripe"
+            )
+
+        start = (first_block - stripe_id * self.pack_size) * BLOCK_SIZE
+        count = last_block - first_block + 1
+        data = self._get_range(self._stripe_key(stripe_id), start, count * BLOCK_SIZE)
+
+        return [data[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE] for i in range(count)]
+
+    def write_unit(self) -> int:
+        """
+        A packed stripe (pack_size blocks) is read-modify-written as a whole
+        unless all its blocks are written in one write_blocks() call.
+        """
+        return self.pack_size or 1
+
+    def list_blocks(self, export_name: str) -> Iterator[int]:
+        """
+        List the blocks that have an object in S3 (every block of a stored
+        stripe, with pack_size set).
+
+        Block ids are yielded as each LIST page arrives (1,000 objects per
+        page), so a caller can start using them, or stop, before a large
+        export is fully listed.
+        """
+        if self.pack_size is None:
+            prefix = self._key_prefix
+        else:
+            prefix = self._stripe_prefix
+
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(prefix):]
+                if not name.isdigit():  # e.g. <id>.tmp left by older versions
+                    continue
+                if self.pack_size is None:
+                    yield int(name)
+                else:
+                    first_block = int(name) * self.pack_size
+                    yield from range(first_block, first_block + self.pack_size)
+
+    def read_blocks(self, export_name: str, block_ids: list[int]) -> list[bytes]:
+        """
+        Read several blocks concurrently. Results are returned in block_ids order.
+
+        With pack_size set, consecutive block_ids that fall in the same stripe
+        are coalesced into one read_range() call.
+        """
+        if self.pack_size is not None:
+            return self._read_blocks_packed(export_name, block_ids)
+
+        if len(block_ids) <= 1:
+            return [self.read_block(export_name, block_id) for block_id in block_ids]
+
+        return list(
+            self._executor.map(
+                lambda block_id: self.read_block(export_name, block_id),
+                block_ids,
+            )
         )
 
-        # Copy temp → real key (atomic S3-side copy)
-        self.s3.copy_object(
-            Bucket=self.bucket,
-            CopySource={"Bucket": self.bucket, "Key": tmp_key},
-            Key=key,
+    def write_blocks(self, export_name: str, items: list[tuple[int, bytes]]) -> None:
+        """
+        Write several blocks concurrently. Returns once every block is written;
+        the first failure (if any) is re-raised.
+
+        With pack_size set, blocks are grouped by stripe and each stripe is
+        written once (a single PUT, or a multipart upload for large stripes),
+        so a contiguous run of dirty blocks costs one upload per stripe it
+        spans; a stripe covered entirely is uploaded without reading it first.
+        """
+        if self.pack_size is not None:
+            stripes: dict[int, dict[int, bytes]] = {}
+            for block_id, data in items:
+                if len(data) != BLOCK_SIZE:
+                    raise ValueError(
+                        f"data must be exactly {BLOCK_SIZE} bytes; got {len(data)} bytes"
+                    )
+                stripes.setdefault(block_id // self.pack_size, {})[block_id] = data
+
+            list(
+                self._executor.map(
+                    lambda stripe: self._write_stripe(stripe[0], stripe[1]),
+                    stripes.items(),
+                )
+            )
+            return
+
+        if len(items) <= 1:
+            for block_id, data in items:
+                self.write_block(export_name, block_id, data)
+            return
+
+        # Consume the iterator so worker exceptions propagate to the caller.
+        list(
+            self._executor.map(
+                lambda item: self.write_block(export_name, item[0], item[1]),
+                items,
+            )
+        )
+
+    def close(self) -> None:
+        """
+        Shut down the request thread pools, waiting for in-flight requests.
+        The shared S3 client stays open for other S3Storage instances.
+        """
+        self._executor.shutdown(wait=True)
+        self._part_executor.shutdown(wait=True)
+
+    def _read_blocks_packed(self, export_name: str, block_ids: list[int]) -> list[bytes]:
+        """
+        read_blocks() for the packed layout: split block_ids into runs of
+        consecutive ids within one stripe and issue one ranged GET per run.
+        """
+        runs: list[tuple[int, int]] = []
+        for block_id in block_ids:
+            if (
+                    runs
+                    and block_id == runs[-1][1] + 1
+                    and block_id // self.pack_size == runs[-1][0] // self.pack_size
+            ):
+                runs[-1] = (runs[-1][0], block_id)
+            else:
+                runs.append((block_id, block_id))
+
+        results = self._executor.map(
+            lambda run: self.read_range(export_name, run[0], run[1]),
+            runs,
         )
 
-        # Remove the temporary object
-        self.s3.delete_object(Bucket=self.bucket, Key=tmp_key)
\ No newline at end of file
+        blocks: list[bytes] = []
+        for run_blocks in results:
+            blocks.extend(run_blocks)
+        return blocks
@@ -11,8 +11,11 @@ class Storage(ABC):
 
     All block data passed in or returned must be exactly BLOCK_SIZE bytes. BLOCK_SIZE = 4096 (block has constant size).
 
-    This interface supports read, write operations in block granularity. The Storage interface always reads or writes
-    exactly 1 full block, never a range inside a block
+    Reads and writes through this interface move whole blocks: read_block()/write_block() handle one block,
+    read_blocks()/write_blocks() handle several in one call. Backends may store blocks in larger units (write_unit(),
+    e.g. packed S3 stripes, which S3Storage.read_range() reads in one ranged GET), but callers still pass whole blocks.
+    The one exception is get_view(): a backend that can map its device image returns a memoryview of it, which
+    nbd_server slices for byte-range reads and splices partial-block writes into in place.
     nbd_server calculates block_id as `block_id = offset // block_size`
     """
 
@@ -57,6 +60,106 @@ class Storage(ABC):
         Args:
             export_name: Name of the export (namespace).
             block_id: Integer block identifier.
-            data: Bytes to write. Must be exactly BLOCK_SIZE bytes long.
+            data: Bytes to write. Must be exactly BLOCK_SIZE bytes long. May be
+                  any bytes-like object (e.g. a pooled bytearray the caller
+                  re-uses), so implementations must not keep a reference to
+                  it after returning.
         """
         raise NotImplementedError
+
+    # ------------------------------------------------------------------
+    # Batched API. Backends with high per-request latency (e.g. S3) should
+    # override these to issue the per-block requests concurrently.
+    # ------------------------------------------------------------------
+
+    def read_blocks(self, export_name: str, block_ids: list[int]) -> list[bytes]:
+        """
+        Read several blocks in one call.
+
+        The default implementation calls read_block() once per block_id, in
+        order.
+
+        Args:
+            export_name: Name of the export (namespace) the blocks belong to.
+            block_ids: Integer block identifiers to read.
+
+        Returns:
+            A list of BLOCK_SIZE bytes objects, in the same order as block_ids.
+        """
+        return [self.read_block(export_name, block_id) for block_id in block_ids]
+
+    def write_blocks(self, export_name: str, items: list[tuple[int, bytes]]) -> None:
+        """
+        Write several blocks in one call.
+
+        The default implementation calls write_block() once per item, in order.
+
+        Args:
+            export_name: Name of the export (namespace).
+            items: (block_id, data) pairs. Each data must be exactly BLOCK_SIZE
+                   bytes long.
+        """
+        for block_id, data in items:
+            self.write_block(export_name, block_id, data)
+
+    def list_blocks(self, export_name: str):
+        """
+        Return an iterable of the block_ids that may hold non-zero data, or
+        None if the backend cannot tell.
+
+        Blocks not listed are guaranteed to read as zeros, which lets callers
+        skip reading them. Listing extra blocks is allowed (it only costs an
+        unnecessary read later). The default implementation returns None.
+
+        Args:
+            export_name: Name of the export (namespace) to list.
+        """
+        return None
+
+    def write_unit(self) -> int:
+        """
+        Return the number of consecutive blocks the backend stores as one
+        unit (e.g. one packed S3 object), aligned to multiples of it.
+
+        Writing only part of a unit costs a read-modify-write of the whole
+        unit, so callers that batch writes (NbdServer.flush()) should not
+        split a unit across batches. The default implementation returns 1.
+        """
+        return 1
+
+    def get_view(self, export_name: str):
+        """
+        Return a memoryview of the export's whole device image, or None if
+        the backend cannot expose one.
+
+        When available, byte offset N of the device is view[N], so callers
+        can slice a byte range directly instead of assembling it from
+        blocks. A writable view also lets callers store partial-block
+        updates in place. The default implementation returns None.
+
+        Args:
+            export_name: Name of the export (namespace).
+        """
+        return None
+
+    def flush(self, export_name: str) -> None:
+        """
+        Make all blocks previously written for export_name durable.
+
+        write_block()/write_blocks() may leave data buffered (e.g. in the
+        page cache); flush() is the single barrier that forces it out, so
+        many block writes share one sync. The default implementation does
+        nothing, for backends whose writes are durable on return (e.g. S3).
+
+        Args:
+            export_name: Name of the export (namespace) to flush.
+        """
+        return None
+
+    def close(self) -> None:
+        """
+        Release resources held by the backend (open files, threads).
+
+        close() does not flush. The default implementation does nothing.
+        """
+        return None
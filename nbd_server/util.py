@@ -2,10 +2,26 @@
 Utility helpers for block math and constants used by the NBD server.
 """
 
+import threading
+
 # Fixed block size for the entire virtual block device.
 # All blocks read/written must be exactly this size.
 BLOCK_SIZE = 4096
 
+# BLOCK_SIZE must be a power of two, so block math can use shifts and masks:
+#   offset // BLOCK_SIZE  ==  offset >> BLOCK_SHIFT
+#   offset %  BLOCK_SIZE  ==  offset &  BLOCK_MASK
+#   block_id * BLOCK_SIZE ==  block_id << BLOCK_SHIFT
+assert BLOCK_SIZE > 0 and BLOCK_SIZE & (BLOCK_SIZE - 1) == 0, "BLOCK_SIZE must be a power of two"
+BLOCK_SHIFT = BLOCK_SIZE.bit_length() - 1
+BLOCK_MASK = BLOCK_SIZE - 1
+
+# Shared all-zero block, returned for every unwritten block instead of
+# allocating a fresh bytes(BLOCK_SIZE) per miss. bytes is immutable, so
+# sharing it is safe; never wrap it in a writable buffer to mutate it in
+# place (copy it into a bytearray instead).
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
 def block_id_from_offset(offset: int) -> int:
     """
     Convert a byte offset into a block ID.
@@ -15,7 +31,7 @@ def block_id_from_offset(offset: int) -> int:
         BLOCK_SIZE = 4096
         block_id = 2
     """
-    return offset // BLOCK_SIZE
+    return offset >> BLOCK_SHIFT
 
 def block_offset_inside_block(offset: int) -> int:
     """
@@ -26,7 +42,7 @@ def block_offset_inside_block(offset: int) -> int:
         BLOCK_SIZE = 4096
         block_offset = 8200 % 4096 = 8
     """
-    return offset % BLOCK_SIZE
+    return offset & BLOCK_MASK
 
 def blocks_touched(offset: int, length: int) -> range:
     """
@@ -50,7 +66,196 @@ def blocks_touched(offset: int, length: int) -> range:
     start = offset
     end = offset + length - 1
 
-    first_block = start // BLOCK_SIZE
-    last_block = end // BLOCK_SIZE
+    first_block = start >> BLOCK_SHIFT
+    last_block = end >> BLOCK_SHIFT
+
+    return range(first_block, last_block + 1)
+
+
+# BlockBitmap scans skip all-clear runs of _SCAN_CHUNK bytes (512 Ki blocks)
+# with one C-level comparison (a memcmp against _CLEAR), then decode the
+# remaining set bits _SCAN_LINE bytes (512 blocks) at a time.
+_SCAN_CHUNK = 64 * 1024
+_SCAN_LINE = 64
+_CLEAR = bytes(_SCAN_CHUNK)
+
+
+class BlockBitmap:
+    """
+    Set of block_ids in [0, num_blocks), stored as one bit per block.
+
+    A set of Python ints costs ~28+ bytes per member; this costs 1 bit per
+    block of the device regardless of how many are set.
+
+        byte index = block_id >> 3
+        bit mask   = 1 << (block_id & 7)
+
+    Iteration yields the set block_ids in ascending order. Iteration,
+    len() and bool() skip clear regions in C, so on a large, mostly clean
+    device they cost far less than one Python step per block or per word.
+    """
+
+    def __init__(self, num_blocks: int) -> None:
+        self.num_blocks = num_blocks
+        self._bits = bytearray((num_blocks + 7) >> 3)
+
+    def add(self, block_id: int) -> None:
+        self._bits[block_id >> 3] |= 1 << (block_id & 7)
+
+    def discard(self, block_id: int) -> None:
+        self._bits[block_id >> 3] &= ~(1 << (block_id & 7)) & 0xFF
+
+    def add_range(self, start: int, stop: int) -> None:
+        """
+        Add block_ids [start, stop). Whole bytes are set with one slice
+        assignment; only the partial bytes at either end go bit by bit.
+        """
+        first_byte = (start + 7) >> 3
+        last_byte = stop >> 3
+        if first_byte >= last_byte:
+            for block_id in range(start, stop):
+                self.add(block_id)
+            return
+
+        for block_id in range(start, first_byte << 3):
+            self.add(block_id)
+        self._bits[first_byte:last_byte] = b"\xff" * (last_byte - first_byte)
+        for block_id in range(last_byte << 3, stop):
+            self.add(block_id)
+
+    def contains_range(self, start: int, stop: int) -> bool:
+        """
+        Return True if every block_id in [start, stop) is set. Whole bytes
+        are checked with one slice comparison; only the partial bytes at
+        either end go bit by bit.
+        """
+        first_byte = (start + 7) >> 3
+        last_byte = stop >> 3
+        if first_byte >= last_byte:
+            return all(block_id in self for block_id in range(start, stop))
+
+        return (
+            self._bits[first_byte:last_byte] == b"\xff" * (last_byte - first_byte)
+            and all(block_id in self for block_id in range(start, first_byte << 3))
+            and all(block_id in self for block_id in range(last_byte << 3, stop))
+        )
+
+    def update(self, block_ids) -> None:
+        """
+        Add every block_id from an iterable, ignoring ids outside the bitmap.
+        """
+        for block_id in block_ids:
+            if 0 <= block_id < self.num_blocks:
+                self.add(block_id)
+
+    def difference_update(self, block_ids) -> None:
+        """
+        Discard every block_id from an iterable.
+        """
+        for block_id in block_ids:
+            self.discard(block_id)
+
+    def union_update(self, other: "BlockBitmap") -> None:
+        """
+        Add every block_id set in another BlockBitmap of the same size.
+        Only the chunks set in `other` are OR-ed, each as one integer in C,
+        so a sparse `other` costs little even on a very large bitmap.
+        """
+        bits = self._bits
+        for start, end in other._set_chunks():
+            merged = int.from_bytes(bits[start:end], "little") | int.from_bytes(other._bits[start:end], "little")
+            bits[start:end] = merged.to_bytes(end - start, "little")
+
+    def clear(self) -> None:
+        self._bits[:] = bytes(len(self._bits))
+
+    def __contains__(self, block_id: int) -> bool:
+        return bool(self._bits[block_id >> 3] & (1 << (block_id & 7)))
+
+    def _set_chunks(self, size: int = _SCAN_CHUNK):
+        """
+        Yield (start, end) byte ranges of the `size`-byte chunks of the
+        bitmap that have at least one bit set.
+        """
+        bits = self._bits
+        for start in range(0, len(bits), size):
+            end = min(start + size, len(bits))
+            if bits[start:end] != _CLEAR[:end - start]:
+                yield start, end
+
+    def __len__(self) -> int:
+        bits = self._bits
+        return sum(
+            int.from_bytes(bits[start:end], "little").bit_count()
+            for start, end in self._set_chunks()
+        )
+
+    def __bool__(self) -> bool:
+        return next(self._set_chunks(), None) is not None
+
+    def __iter__(self):
+        bits = self._bits
+        for chunk_start, chunk_end in self._set_chunks():
+            for start in range(chunk_start, chunk_end, _SCAN_LINE):
+                end = min(start + _SCAN_LINE, chunk_end)
+                if bits[start:end] == _CLEAR[:end - start]:
+                    continue
+                # Byte i, bit j is block (start + i) * 8 + j: little-endian.
+                line = int.from_bytes(bits[start:end], "little")
+                base = start << 3
+                while line:
+                    low = line & -line
+                    yield base + low.bit_length() - 1
+                    line ^= low
+
+
+class BufferPool:
+    """
+    Per-thread freelist of reusable BLOCK_SIZE bytearrays.
+
+    Read-modify-write needs a scratch block for every partial-block write.
+    Re-using a few buffers instead of allocating a fresh 4 KiB bytearray
+    each time takes malloc/free off the hot path and keeps the buffers warm
+    in CPU cache. Each thread has its own stack, so no locking is needed.
+
+    Usage:
+        buf = pool.acquire()
+        try:
+            ...
+        finally:
+            pool.release(buf)
+
+    Acquired buffers hold stale data from their previous use.
+    """
+
+    def __init__(self, max_buffers: int = 32) -> None:
+        """
+        Args:
+            max_buffers: Maximum number of idle buffers kept per thread.
+        """
+        self.max_buffers = max_buffers
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def acquire(self) -> bytearray:
+        """
+        Return a BLOCK_SIZE bytearray (contents undefined).
+        """
+        stack = self._stack()
+        if stack:
+            return stack.pop()
+        return bytearray(BLOCK_SIZE)
 
-    return range(first_block, last_block + 1)
\ No newline at end of file
+    def release(self, buf: bytearray) -> None:
+        """
+        Return a buffer to this thread's freelist. Buffers that are no longer
+        BLOCK_SIZE bytes, or beyond max_buffers, are dropped.
+        """
+        stack = self._stack()
+        if len(buf) == BLOCK_SIZE and len(stack) < self.max_buffers:
+            stack.append(buf)
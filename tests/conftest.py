@@ -0,0 +1,80 @@
+"""
+Shared pytest configuration.
+
+Tests that talk to S3 get the endpoint from the `s3_endpoint` fixture. By
+default that is an in-process moto mock of S3 (no sockets, no MinIO
+container needed), and they run as ordinary fast tests. To run them
+against a live S3-compatible server instead (e.g. MinIO, nightly):
+
+    pytest --s3-endpoint=http://localhost:9000
+
+They are then marked `integration`, so `-m integration` runs only the
+live-server tests and `-m "not integration"` skips them.
+"""
+
+import boto3
+import pytest
+
+from botocore.exceptions import ClientError
+
+BUCKET = "nbdbucket"
+ACCESS_KEY = "minioadmin"
+SECRET_KEY = "minioadmin"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--s3-endpoint",
+        default=None,
+        help="Run S3 tests against this live endpoint instead of a moto mock.",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "integration: test talks to the live S3 server given by --s3-endpoint",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--s3-endpoint") is None:
+        return
+    for item in items:
+        if "s3_endpoint" in getattr(item, "fixturenames", ()):
+            item.add_marker(pytest.mark.integration)
+
+
+@pytest.fixture(scope="session")
+def s3_endpoint(request):
+    """
+    Endpoint URL to pass to boto3 / S3Storage, with BUCKET created.
+
+    None means the default AWS endpoint, which moto intercepts in-process.
+    """
+    endpoint = request.config.getoption("--s3-endpoint")
+    if endpoint is not None:
+        client = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name="us-east-1",
+            aws_access_key_id=ACCESS_KEY,
+            aws_secret_access_key=SECRET_KEY,
+        )
+        try:
+            client.create_bucket(Bucket=BUCKET)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
+        yield endpoint
+        return
+
+    moto = pytest.importorskip("moto", reason="moto is needed for S3 tests without --s3-endpoint")
+    with moto.mock_aws():
+        boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id=ACCESS_KEY,
+            aws_secret_access_key=SECRET_KEY,
+        ).create_bucket(Bucket=BUCKET)
+        yield None
@@ -0,0 +1,62 @@
+from nbd_server.cache import BlockCache
+from nbd_server.util import BLOCK_SIZE
+
+
+def block(fill: int) -> bytes:
+    return bytes([fill]) * BLOCK_SIZE
+
+
+def test_get_returns_cached_block():
+    cache = BlockCache(limit_bytes=BLOCK_SIZE * 4)
+    cache.put(1, block(1))
+
+    assert cache.get(1) == block(1)
+    assert cache.get(2) is None
+
+
+def test_evicts_least_recently_used():
+    cache = BlockCache(limit_bytes=BLOCK_SIZE * 2)
+    cache.put(1, block(1))
+    cache.put(2, block(2))
+
+    cache.get(1)           # 2 is now least recently used
+    cache.put(3, block(3))
+
+    assert cache.get(2) is None
+    assert cache.get(1) == block(1)
+    assert cache.get(3) == block(3)
+    assert len(cache) == 2
+
+
+def test_put_replaces_and_invalidate_drops():
+    cache = BlockCache(limit_bytes=BLOCK_SIZE * 2)
+    cache.put(1, block(1))
+    cache.put(1, block(9))
+    cache.put(2, block(2))
+
+    assert len(cache) == 2
+    assert cache.get(1) == block(9)
+
+    cache.invalidate(1)
+    cache.invalidate(5)    # not cached: no-op
+    assert cache.get(1) is None
+    assert len(cache) == 1
+
+
+def test_invalidate_range():
+    cache = BlockCache(limit_bytes=BLOCK_SIZE * 4)
+    for block_id in (1, 5, 9, 200):
+        cache.put(block_id, block(block_id))
+
+    cache.invalidate_range(4, 10)          # shorter than the cache
+    cache.invalidate_range(199, 10**9)     # longer than the cache
+
+    assert cache.get(1) == block(1)
+    assert len(cache) == 1
+
+
+def test_zero_limit_disables_cache():
+    cache = BlockCache(limit_bytes=0)
+    cache.put(1, block(1))
+
+    assert cache.get(1) is None
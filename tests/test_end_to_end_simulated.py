@@ -1,32 +1,24 @@
 # Simulated end-to-end durability test for NbdServer
 
-import os
-import shutil
-
 from nbd_server.nbd_server import NbdServer
 from nbd_server.file_storage import FileStorage
 from nbd_server.s3_storage import S3Storage
 
 BLOCK_SIZE = 4096
 EXPORT = "simtest"
-VOL_PATH = "../data/exports"
 BUCKET = "nbdbucket"
 
 
-def setup_function():
-    # Clean volatile storage for fresh test
-    export_path = os.path.join(VOL_PATH, EXPORT)
-    if os.path.exists(export_path):
-        shutil.rmtree(export_path)
-
+def test_simulated_end_to_end_durability(tmp_path, s3_endpoint):
+    # Fresh volatile storage for this test
+    vol_path = tmp_path / "exports"
 
-def test_simulated_end_to_end_durability():
     # Phase 1: Create server with volatile + durable storage
-    volatile = FileStorage(VOL_PATH)
+    volatile = FileStorage(vol_path)
     durable = S3Storage(
         bucket=BUCKET,
         export_name=EXPORT,
-        endpoint_url="http://localhost:9000",
+        endpoint_url=s3_endpoint,
         aws_access_key_id="minioadmin",
         aws_secret_access_key="minioadmin",
     )
@@ -38,20 +30,23 @@ def test_simulated_end_to_end_durability():
         nonvolatile_storage=durable
     )
 
-    # Step 1: Write data at several offsets
-    server.write(0, b"AAAAAA")
-    server.write(4096, b"BBBBBBBB")
-    server.write(8192, b"CCCCCCCCCCCC")
+    try:
+        # Step 1: Write data at several offsets
+        server.write(0, b"AAAAAA")
+        server.write(4096, b"BBBBBBBB")
+        server.write(8192, b"CCCCCCCCCCCC")
 
-    # Step 2: Flush to durable storage
-    server.flush()
+        # Step 2: Flush to durable storage
+        server.flush()
+    finally:
+        server.close()
 
     # Phase 2: Simulate restart
-    volatile2 = FileStorage(VOL_PATH)
+    volatile2 = FileStorage(vol_path)
     durable2 = S3Storage(
         bucket=BUCKET,
         export_name=EXPORT,
-        endpoint_url="http://localhost:9000",
+        endpoint_url=s3_endpoint,
         aws_access_key_id="minioadmin",
         aws_secret_access_key="minioadmin",
     )
@@ -63,9 +58,12 @@ def test_simulated_end_to_end_durability():
         nonvolatile_storage=durable2,
     )
 
-    # Step 3: Read data back from durable storage
-    assert server2.read(0, 6) == b"AAAAAA"
-    assert server2.read(4096, 8) == b"BBBBBBBB"
-    assert server2.read(8192, 12) == b"CCCCCCCCCCCC"
+    try:
+        # Step 3: Read data back from durable storage
+        assert server2.read(0, 6) == b"AAAAAA"
+        assert server2.read(4096, 8) == b"BBBBBBBB"
+        assert server2.read(8192, 12) == b"CCCCCCCCCCCC"
+    finally:
+        server2.close()
 
     print("Simulated end-to-end durability test PASSED")
\ No newline at end of file
@@ -1,28 +1,12 @@
+import errno
 import os
-import shutil
 
 from nbd_server.file_storage import FileStorage
-from nbd_server.util import BLOCK_SIZE
+from nbd_server.util import BLOCK_SIZE, ZERO_BLOCK
 
 
-TEST_BASE = "test_data"   # isolated test directory
-
-# Set up function.
-def setup_function():
-    """Run before each test: clean and recreate test directory."""
-    if os.path.exists(TEST_BASE):
-        shutil.rmtree(TEST_BASE)
-    os.makedirs(TEST_BASE)
-
-
-def teardown_function():
-    """Run after each test: clean up."""
-    if os.path.exists(TEST_BASE):
-        shutil.rmtree(TEST_BASE)
-
-
-def test_read_missing_block_returns_zero_fill():
-    storage = FileStorage(base_path=TEST_BASE)
+def test_read_missing_block_returns_zero_fill(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
     data = storage.read_block("dev1", 0)
 
     assert isinstance(data, bytes)
@@ -30,8 +14,8 @@ def test_read_missing_block_returns_zero_fill():
     assert data == bytes(BLOCK_SIZE)  # zero-filled
 
 
-def test_write_and_read_roundtrip():
-    storage = FileStorage(base_path=TEST_BASE)
+def test_write_and_read_roundtrip(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
     block_id = 3
     write_bytes = b"hello world" + bytes(BLOCK_SIZE - 11)
 
@@ -41,53 +25,200 @@ def test_write_and_read_roundtrip():
     assert read_bytes == write_bytes
 
 
-def test_write_creates_correct_path():
-    storage = FileStorage(base_path=TEST_BASE)
+def test_write_creates_correct_path(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
     block_id = 7
     write_bytes = b"A" * BLOCK_SIZE
 
     storage.write_block("dev1", block_id, write_bytes)
 
-    expected_path = os.path.join(
-        TEST_BASE, "exports", "dev1", "blocks", str(block_id)
-    )
+    expected_path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
     assert os.path.exists(expected_path)
 
     with open(expected_path, "rb") as f:
         on_disk = f.read()
-    assert on_disk == write_bytes
+    # Blocks before block_id are holes and read back as zeros.
+    assert on_disk == bytes(block_id * BLOCK_SIZE) + write_bytes
 
 
-def test_read_block_normalizes_oversized_block():
-    """If a block file is too large, FileStorage should truncate it."""
-    storage = FileStorage(base_path=TEST_BASE)
+def test_read_block_from_oversized_backing_file(tmp_path):
+    """A block is exactly BLOCK_SIZE bytes even if the file continues past it."""
+    storage = FileStorage(base_path=tmp_path)
     oversized = b"X" * (BLOCK_SIZE + 100)
-    block_id = 1
 
-    path = os.path.join(TEST_BASE, "exports", "dev1", "blocks", str(block_id))
+    path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
     with open(path, "wb") as f:
         f.write(oversized)
 
-    normalized = storage.read_block("dev1", block_id)
+    normalized = storage.read_block("dev1", 0)
     assert len(normalized) == BLOCK_SIZE
     assert normalized == b"X" * BLOCK_SIZE
 
 
-def test_read_block_normalizes_short_block():
-    """If a block is too small, FileStorage pads it with zeros."""
-    storage = FileStorage(base_path=TEST_BASE)
+def test_read_block_normalizes_short_block(tmp_path):
+    """If the backing file ends inside a block, FileStorage pads it with zeros."""
+    storage = FileStorage(base_path=tmp_path)
     short = b"Y" * 100
     block_id = 2
 
-    path = os.path.join(TEST_BASE, "exports", "dev1", "blocks", str(block_id))
+    path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
     with open(path, "wb") as f:
+        f.seek(block_id * BLOCK_SIZE)
         f.write(short)
 
     normalized = storage.read_block("dev1", block_id)
     assert len(normalized) == BLOCK_SIZE
     assert normalized.startswith(b"Y" * 100)
-    assert normalized[100:] == bytes(BLOCK_SIZE - 100)
\ No newline at end of file
+    assert normalized[100:] == bytes(BLOCK_SIZE - 100)
+
+    # Blocks entirely past the end of the file are zero-filled.
+    assert storage.read_block("dev1", block_id + 5) == bytes(BLOCK_SIZE)
+
+
+def test_backing_file_extended_to_device_size(tmp_path):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 16)
+    storage.write_block("dev1", 0, b"B" * BLOCK_SIZE)
+
+    path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
+    assert os.path.getsize(path) == BLOCK_SIZE * 16
+    assert storage.read_block("dev1", 15) == bytes(BLOCK_SIZE)
+
+
+def test_flush_syncs_written_blocks(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
+
+    # Flushing an export that was never written is a no-op.
+    storage.flush("dev1")
+
+    storage.write_block("dev1", 4, b"F" * BLOCK_SIZE)
+    storage.flush("dev1")
+
+    assert storage.read_block("dev1", 4) == b"F" * BLOCK_SIZE
+
+
+def test_list_blocks_reports_written_blocks(tmp_path):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 64)
+    assert storage.list_blocks("dev1") == []
+
+    storage.write_block("dev1", 3, b"L" * BLOCK_SIZE)
+    storage.write_block("dev1", 40, b"L" * BLOCK_SIZE)
+
+    listed = storage.list_blocks("dev1")
+    assert listed is not None
+    assert {3, 40} <= set(listed)
+
+
+def test_read_blocks_across_runs(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
+    assert storage.read_blocks("dev1", [0, 1]) == [bytes(BLOCK_SIZE)] * 2
+
+    for block_id in (2, 3, 4, 9):
+        storage.write_block("dev1", block_id, bytes([block_id]) * BLOCK_SIZE)
+
+    # Two runs (2-5, 9-10) plus a lone block, the last ones past the end of
+    # the backing file.
+    block_ids = [2, 3, 4, 5, 9, 10, 0]
+    blocks = storage.read_blocks("dev1", block_ids)
+
+    assert blocks == [storage.read_block("dev1", b) for b in block_ids]
+    assert blocks[2] == b"\x04" * BLOCK_SIZE
+    assert blocks[5] == bytes(BLOCK_SIZE)
+
+
+def test_missing_blocks_share_zero_block(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
+
+    assert storage.read_block("dev1", 0) is ZERO_BLOCK
+    assert all(b is ZERO_BLOCK for b in storage.read_blocks("dev1", [0, 1, 5]))
+
+    # Blocks past the end of an existing backing file share it too.
+    storage.write_block("dev1", 0, b"Z" * BLOCK_SIZE)
+    assert storage.read_block("dev1", 3) is ZERO_BLOCK
+    assert storage.read_blocks("dev1", [0, 1, 2])[1:] == [ZERO_BLOCK, ZERO_BLOCK]
+    assert storage.read_blocks("dev1", [1, 2])[0] is ZERO_BLOCK
+
+
+def test_backing_file_is_sparse_and_unmapped_by_default(tmp_path):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 1024)
+    storage.write_block("dev1", 2, b"S" * BLOCK_SIZE)
+
+    path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
+    assert os.stat(path).st_blocks * 512 < BLOCK_SIZE * 1024
+    assert storage.get_view("dev1") is None
+    assert storage.read_block("dev1", 2) == b"S" * BLOCK_SIZE
+
+
+def test_mapped_backing_file_view(tmp_path):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 8, reserve=True)
+    assert storage.get_view("dev1") is None
+
+    storage.write_block("dev1", 2, b"M" * BLOCK_SIZE)
+    view = storage.get_view("dev1")
+    assert len(view) == BLOCK_SIZE * 8
+    assert view[2 * BLOCK_SIZE:3 * BLOCK_SIZE] == b"M" * BLOCK_SIZE
+    view.release()
+
+    storage.flush("dev1")
+    path = os.path.join(tmp_path, "exports", "dev1", "blocks.img")
+    with open(path, "rb") as f:
+        f.seek(2 * BLOCK_SIZE)
+        assert f.read(BLOCK_SIZE) == b"M" * BLOCK_SIZE
+
+
+def test_unreservable_backing_file_is_not_mapped(tmp_path, monkeypatch):
+    def full_disk(fd, offset, length):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(os, "posix_fallocate", full_disk, raising=False)
+
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 8, reserve=True)
+    storage.write_block("dev1", 2, b"M" * BLOCK_SIZE)
+
+    # Writes go through pwrite(), which reports ENOSPC instead of SIGBUS.
+    assert storage.get_view("dev1") is None
+    assert storage.read_block("dev1", 2) == b"M" * BLOCK_SIZE
+
+
+def test_missing_backing_file_is_looked_up_once(tmp_path, monkeypatch):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 8, reserve=True)
+    lookups = []
+    exists = os.path.exists
+    monkeypatch.setattr(os.path, "exists", lambda path: lookups.append(path) or exists(path))
+
+    assert storage.get_view("dev1") is None
+    assert storage.get_view("dev1") is None
+    assert storage.read_block("dev1", 0) == bytes(BLOCK_SIZE)
+    assert len(lookups) == 1
+
+    # Writing creates the image; it is then mapped as usual.
+    storage.write_block("dev1", 2, b"M" * BLOCK_SIZE)
+    view = storage.get_view("dev1")
+    assert view[2 * BLOCK_SIZE:3 * BLOCK_SIZE] == b"M" * BLOCK_SIZE
+    view.release()
+
+
+def test_close_releases_files_and_reopens_on_use(tmp_path):
+    storage = FileStorage(base_path=tmp_path, total_size_bytes=BLOCK_SIZE * 8)
+    storage.write_block("dev1", 1, b"C" * BLOCK_SIZE)
+
+    storage.close()
+    storage.close()
+
+    assert storage.read_block("dev1", 1) == b"C" * BLOCK_SIZE
+    storage.close()
+
+
+def test_write_blocks_across_runs(tmp_path):
+    storage = FileStorage(base_path=tmp_path)
+    items = [(b, bytes([b]) * BLOCK_SIZE) for b in (3, 4, 5, 9, 1)]
+    # Writers may pass zero-copy slices of a larger buffer.
+    items.append((10, memoryview(b"W" * (BLOCK_SIZE * 2))[BLOCK_SIZE:]))
+
+    storage.write_blocks("dev1", items)
+
+    for block_id, data in items:
+        assert storage.read_block("dev1", block_id) == bytes(data)
+    assert storage.read_block("dev1", 6) == bytes(BLOCK_SIZE)
@@ -1,29 +1,30 @@
+import itertools
 import os
-import shutil
+import threading
+import time
+from unittest import mock
+
+import pytest
 
 from nbd_server.nbd_server import NbdServer
 from nbd_server.util import BLOCK_SIZE
 from nbd_server.file_storage import FileStorage
+from nbd_server.s3_storage import S3Storage
 
 
-TEST_BASE = "test_data"
-TEST_DURABLE = "test_data_durable"
+def written_block_ids(write_blocks):
+    """Block ids of each call to a mocked Storage.write_blocks(export, items)."""
+    return [[block_id for block_id, _ in c.args[1]] for c in write_blocks.call_args_list]
 
 
 class TestNbdServer:
-    def setup_method(self, method):
-        # Ensure storage directories are reset
-        if os.path.exists(TEST_BASE):
-            shutil.rmtree(TEST_BASE)
-        if os.path.exists(TEST_DURABLE):
-            shutil.rmtree(TEST_DURABLE)
-
-        os.makedirs(TEST_BASE)
-        os.makedirs(TEST_DURABLE)
-
-        # Create fresh storage objects (no lingering state)
-        self.volatile = FileStorage(TEST_BASE)
-        self.durable = FileStorage(TEST_DURABLE)  # placeholder until S3Storage added
+    @pytest.fixture(autouse=True)
+    def storage(self, tmp_path):
+        # Fresh storage directories and objects for every test (tmp_path is
+        # unique per test, so there is no lingering state to clean up).
+        self.volatile_path = tmp_path / "volatile"
+        self.volatile = FileStorage(self.volatile_path)
+        self.durable = FileStorage(tmp_path / "durable")  # placeholder until S3Storage added
 
         # Create a fresh NbdServer for every test
         self.server = NbdServer(
@@ -33,18 +34,24 @@ class TestNbdServer:
             nonvolatile_storage=self.durable
         )
 
-    def teardown_method(self, method):
-        if os.path.exists(TEST_BASE):
-            shutil.rmtree(TEST_BASE)
-        if os.path.exists(TEST_DURABLE):
-            shutil.rmtree(TEST_DURABLE)
+        self.servers = [self.server]
 
-    def make_server(self, size_blocks=10):
-        return NbdServer(
-            "dev1",
+        yield
+
+        for server in self.servers:
+            server.close()
+
+    def make_server(self, size_blocks=10, export="dev1", volatile=None, durable=None, **kwargs):
+        # Every server made here is closed by the fixture, so its
+        # block-listing thread never outlives the test.
+        server = NbdServer(
+            export,
             total_size_bytes=BLOCK_SIZE * size_blocks,
-            volatile_storage=self.volatile,
-            nonvolatile_storage=self.durable)
+            volatile_storage=volatile or self.volatile,
+            nonvolatile_storage=durable or self.durable,
+            **kwargs)
+        self.servers.append(server)
+        return server
 
     def test_single_block_write_and_read(self):
         server = self.make_server()
@@ -115,29 +122,25 @@ class TestNbdServer:
     def test_out_of_bounds_read(self):
         server = self.make_server()
 
-        try:
+        with pytest.raises(ValueError):
             server.read(BLOCK_SIZE * 10 - 100, 200)
-        except ValueError:
-            return
-
-        assert False, "Expected read to raise ValueError for out-of-bounds"
+        with pytest.raises(ValueError):
+            server.read(-1, 10)
+        with pytest.raises(ValueError):
+            server.read(100, -10)
 
     def test_out_of_bounds_write(self):
         server = self.make_server()
 
-        try:
+        with pytest.raises(ValueError):
             server.write(BLOCK_SIZE * 10 - 10, b"1234567890123456")
-        except ValueError:
-            return
-
-        assert False, "Expected write to raise ValueError for out-of-bounds write"
 
     def test_flush_persists_dirty_blocks(self):
         server = self.make_server()
         data = b"XYZ"
         server.write(0, data)
         # Before flush, durable storage should have no blocks
-        assert not os.path.exists(os.path.join(TEST_DURABLE, "exports/dev1/blocks/0"))
+        assert self.durable.read_block("dev1", 0) == bytes(BLOCK_SIZE)
 
         server.flush()
 
@@ -153,4 +156,317 @@ class TestNbdServer:
         server.flush()
 
         # Dirty blocks should be cleared
-        assert len(server.dirty_blocks) == 0
\ No newline at end of file
+        assert len(server.dirty_blocks) == 0
+
+    def test_read_through_from_durable_storage(self):
+        # Block present only in durable storage (e.g. after a restart).
+        self.durable.write_block("dev1", 2, b"D" * BLOCK_SIZE)
+        server = self.make_server()
+
+        assert server.read(2 * BLOCK_SIZE, 4) == b"DDDD"
+
+        # The block is now resident in volatile storage.
+        assert self.volatile.read_block("dev1", 2) == b"D" * BLOCK_SIZE
+
+    def test_partial_write_merges_with_durable_block(self):
+        self.durable.write_block("dev1", 1, b"D" * BLOCK_SIZE)
+        server = self.make_server()
+
+        server.write(BLOCK_SIZE + 10, b"xyz")
+
+        block1 = server.read(BLOCK_SIZE, BLOCK_SIZE)
+        assert block1 == b"D" * 10 + b"xyz" + b"D" * (BLOCK_SIZE - 13)
+
+    def test_sequential_reads_prefetch_following_blocks(self):
+        for block_id in range(10):
+            self.durable.write_block("dev1", block_id, bytes([65 + block_id]) * BLOCK_SIZE)
+        server = self.make_server()
+
+        server.read(0, BLOCK_SIZE)
+        server.read(BLOCK_SIZE, BLOCK_SIZE)  # sequential → readahead
+        server._reader.wait()
+
+        for block_id in range(2, 10):
+            assert self.volatile.read_block("dev1", block_id) == bytes([65 + block_id]) * BLOCK_SIZE
+
+    def test_prefetch_does_not_overwrite_newer_write(self):
+        self.durable.write_block("dev1", 3, b"O" * BLOCK_SIZE)
+        server = self.make_server()
+        server.write(3 * BLOCK_SIZE, b"N" * BLOCK_SIZE)
+
+        server.read(0, BLOCK_SIZE)
+        server.read(BLOCK_SIZE, BLOCK_SIZE)
+        server._reader.wait()
+
+        assert server.read(3 * BLOCK_SIZE, BLOCK_SIZE) == b"N" * BLOCK_SIZE
+
+    def test_partial_write_to_unwritten_block_skips_read(self):
+        self.durable.write_block("dev1", 1, b"D" * BLOCK_SIZE)
+        server = self.make_server()
+        server.start_listing()
+        server._written_ready.wait()
+
+        with mock.patch.object(self.durable, "read_blocks", wraps=self.durable.read_blocks) as read_blocks:
+            server.write(5 * BLOCK_SIZE + 10, b"new")   # block 5: never written
+            server.write(BLOCK_SIZE + 10, b"old")       # block 1: exists durably
+
+        assert read_blocks.call_args_list == [mock.call("dev1", [1])]
+        assert server.read(5 * BLOCK_SIZE, 16) == bytes(10) + b"new" + bytes(3)
+
+    def test_block_listing_does_not_block_requests(self):
+        self.durable.write_block("dev1", 1, b"D" * BLOCK_SIZE)
+
+        listing = threading.Event()
+        list_blocks = self.durable.list_blocks
+        with mock.patch.object(
+                self.durable, "list_blocks",
+                side_effect=lambda export: listing.wait() and list_blocks(export)):
+            server = self.make_server()
+
+            # While the listing runs, nothing is assumed about unlisted blocks.
+            server.write(BLOCK_SIZE + 10, b"old")
+            server.write(5 * BLOCK_SIZE, b"new")
+            assert server._written_blocks() is None
+
+            listing.set()
+            server._written_ready.wait()
+
+        # Listed blocks and blocks written meanwhile are both known.
+        assert {1, 5} <= set(server._written_blocks())
+        assert 2 not in server._written_blocks()
+        assert server.read(BLOCK_SIZE + 9, 5) == b"Dold" + b"D"
+
+    def test_close_stops_block_listing(self):
+        listed = []
+
+        def endless_listing(export):
+            for block_id in itertools.count():
+                listed.append(block_id)
+                yield block_id
+
+        with mock.patch.object(self.durable, "list_blocks", side_effect=endless_listing):
+            server = self.make_server()
+            server.start_listing()
+            server.close()
+
+        assert not server._lister.is_alive()
+        count = len(listed)
+        time.sleep(0.05)
+        assert len(listed) == count  # nothing lists after close()
+        assert server._written_blocks() is None
+
+    def test_listing_starts_on_first_request(self):
+        # Nothing is listed at construction, which may happen before a fork.
+        with mock.patch.object(self.durable, "list_blocks", wraps=self.durable.list_blocks) as list_blocks:
+            server = self.make_server()
+            assert server._lister is None
+
+            server.read(0, 1)
+            server._written_ready.wait()
+
+        list_blocks.assert_called_once_with("dev1")
+
+    def test_close_without_requests_does_not_list(self):
+        server = self.make_server()
+        server.close()
+
+        assert server._lister is None
+        server.start_listing()  # no-op once closed
+        assert server._lister is None
+
+    def test_unaligned_read_spanning_many_blocks(self):
+        server = self.make_server()
+        data = bytes(range(256)) * (BLOCK_SIZE * 5 // 256)
+        server.write(0, data)
+
+        offset = BLOCK_SIZE - 7
+        length = BLOCK_SIZE * 3 + 11
+        assert server.read(offset, length) == data[offset:offset + length]
+
+    def test_hot_block_reads_are_served_from_cache(self):
+        server = self.make_server()
+        server.write(0, b"hot".ljust(BLOCK_SIZE, b"\0"))
+
+        with mock.patch.object(self.volatile, "read_blocks", wraps=self.volatile.read_blocks) as read_blocks:
+            assert server.read(0, 3) == b"hot"
+            assert server.read(0, 3) == b"hot"
+            assert read_blocks.call_args_list == [mock.call("dev1", [0])]
+
+            # A whole-block write invalidates the cached copy.
+            server.write(0, b"HOT".ljust(BLOCK_SIZE, b"\0"))
+            assert server.read(0, 3) == b"HOT"
+            assert read_blocks.call_args_list == [mock.call("dev1", [0])] * 2
+
+    def test_partial_writes_update_cached_block(self):
+        server = self.make_server()
+        server.write(0, b"hot")
+
+        # The read-modify-write and the read both hit the cached block.
+        with mock.patch.object(self.volatile, "read_blocks", wraps=self.volatile.read_blocks) as read_blocks:
+            server.write(1, b"OT")
+            assert server.read(0, 3) == b"hOT"
+
+        read_blocks.assert_not_called()
+
+    def test_bulk_and_zero_reads_do_not_evict_hot_blocks(self):
+        server = self.make_server(300, cache_limit_bytes=BLOCK_SIZE * 100)
+        server.write(0, b"hot".ljust(BLOCK_SIZE, b"\0"))
+        server.write(BLOCK_SIZE * 50, b"\x01" * (BLOCK_SIZE * 40))
+        assert server.read(0, 3) == b"hot"
+
+        # Never-written blocks, and every block of a large read, stay out
+        # of the cache.
+        assert server.read(BLOCK_SIZE * 100, BLOCK_SIZE * 200) == bytes(BLOCK_SIZE * 200)
+        assert server.read(BLOCK_SIZE * 50, 4) == b"\x01" * 4
+        assert server.read(BLOCK_SIZE * 50, BLOCK_SIZE * 40) == b"\x01" * (BLOCK_SIZE * 40)
+        assert len(server._cache) == 2
+        assert server._cache.get(0) is not None
+
+    def test_flush_of_many_batches(self):
+        server = self.make_server(2048)
+        # Scattered blocks (three full batches) plus a contiguous run.
+        block_ids = list(range(3, 1800, 2)) + list(range(1900, 1920))
+        for block_id in block_ids:
+            server.write(block_id * BLOCK_SIZE, block_id.to_bytes(4, "big"))
+
+        server.flush()
+
+        assert len(server.dirty_blocks) == 0
+        for block_id in block_ids:
+            assert self.durable.read_block("dev1", block_id)[:4] == block_id.to_bytes(4, "big")
+
+    def test_flush_writes_each_large_stripe_once(self, s3_endpoint):
+        # 2048-block (8 MiB) stripes: a flush batch must hold whole stripes,
+        # or every batch would read-modify-write the entire stripe.
+        durable = S3Storage(
+            bucket="nbdbucket",
+            export_name="flush-stripes",
+            endpoint_url=s3_endpoint,
+            aws_access_key_id="minioadmin",
+            aws_secret_access_key="minioadmin",
+            pack_size=2048,
+        )
+        server = self.make_server(4096, export="flush-stripes", durable=durable)
+        server.start_listing()
+        server._written_ready.wait()  # so the write to stripe 1 skips its read
+
+        data = os.urandom(BLOCK_SIZE * 2048)
+        with mock.patch.object(durable, "_write_stripe", wraps=durable._write_stripe) as write_stripe, \
+                mock.patch.object(durable, "_get_range", wraps=durable._get_range) as get_range:
+            server.write(0, data)
+            server.write(BLOCK_SIZE * 2048, b"x")
+            server.flush()
+
+        stripe_writes = [(c.args[0], len(c.args[1])) for c in write_stripe.call_args_list]
+        assert sorted(stripe_writes) == [(0, 2048), (1, 1)]
+        assert [c.args[0] for c in get_range.call_args_list] == ["exports/flush-stripes/stripes/1"]
+        assert durable.read_blocks("flush-stripes", [0, 2047]) == [
+            data[:BLOCK_SIZE], data[-BLOCK_SIZE:]
+        ]
+
+    def test_scattered_dirty_blocks_are_uploaded_in_full_concurrent_batches(self):
+        server = self.make_server(4096)
+        # Every other block: four batches of 256 dirty blocks each.
+        block_ids = list(range(0, 2048, 2))
+        for block_id in block_ids:
+            server.write(block_id * BLOCK_SIZE, b"x")
+
+        active, max_active = [0], [0]
+        lock = threading.Lock()
+        write_blocks = self.durable.write_blocks
+
+        def slow_write_blocks(export, items):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.05)  # one S3 round trip
+            write_blocks(export, items)
+            with lock:
+                active[0] -= 1
+
+        with mock.patch.object(self.durable, "write_blocks", side_effect=slow_write_blocks) as spy:
+            server.flush()
+
+        assert [len(c.args[1]) for c in spy.call_args_list] == [256] * 4
+        assert max_active[0] > 1
+        assert len(server.dirty_blocks) == 0
+        assert self.durable.read_block("dev1", 2046)[:1] == b"x"
+
+    def test_failed_flush_keeps_blocks_dirty(self):
+        server = self.make_server(2048)
+        server.write(0, b"x" * (BLOCK_SIZE * 1024))  # four batches
+
+        with mock.patch.object(self.durable, "write_blocks", side_effect=OSError("upload failed")):
+            with pytest.raises(OSError):
+                server.flush()
+
+        assert len(server.dirty_blocks) == 1024
+
+    def test_resident_range_is_sliced_from_mapped_volatile_storage(self):
+        volatile = FileStorage(self.volatile_path, total_size_bytes=BLOCK_SIZE * 10, reserve=True)
+        server = self.make_server(10, volatile=volatile)
+        data = os.urandom(BLOCK_SIZE * 2)
+        server.write(BLOCK_SIZE, data)
+
+        with mock.patch.object(volatile, "read_blocks", wraps=volatile.read_blocks) as read_blocks:
+            assert server.read(BLOCK_SIZE + 10, BLOCK_SIZE) == data[10:BLOCK_SIZE + 10]
+
+        read_blocks.assert_not_called()  # sliced from the view, not read per block
+
+    def test_aligned_write_is_one_batched_volatile_write(self):
+        server = self.make_server()
+        data = os.urandom(BLOCK_SIZE * 4)
+
+        with mock.patch.object(self.volatile, "write_blocks", wraps=self.volatile.write_blocks) as write_blocks:
+            server.write(BLOCK_SIZE * 2, data)
+
+        assert written_block_ids(write_blocks) == [[2, 3, 4, 5]]
+        assert len(server.dirty_blocks) == 4
+        assert server.read(BLOCK_SIZE * 2, len(data)) == data
+
+    def test_unaligned_write_batches_its_whole_blocks(self):
+        server = self.make_server()
+        server.write(0, b"\x01" * (BLOCK_SIZE * 6))
+
+        # Partial head in block 0, whole blocks 1-3, partial tail in block 4.
+        data = os.urandom(BLOCK_SIZE * 4)
+        with mock.patch.object(self.volatile, "write_blocks", wraps=self.volatile.write_blocks) as write_blocks:
+            server.write(100, data)
+
+        assert written_block_ids(write_blocks) == [[1, 2, 3]]
+        assert server.read(0, 100) == b"\x01" * 100
+        assert server.read(100, len(data)) == data
+        assert server.read(100 + len(data), 100) == b"\x01" * 100
+
+    def test_aligned_write_is_one_copy_into_mapped_volatile_storage(self):
+        volatile = FileStorage(self.volatile_path, total_size_bytes=BLOCK_SIZE * 10, reserve=True)
+        server = self.make_server(10, volatile=volatile)
+        server.write(0, b"\x01" * BLOCK_SIZE)  # creates the image
+
+        data = os.urandom(BLOCK_SIZE * 7)
+        with mock.patch.object(volatile, "write_blocks", wraps=volatile.write_blocks) as write_blocks, \
+                mock.patch.object(volatile, "write_block", wraps=volatile.write_block) as write_block:
+            server.write(BLOCK_SIZE * 2, data)
+
+        # The mapped run is copied in one go, not written per block.
+        write_blocks.assert_not_called()
+        write_block.assert_not_called()
+        assert list(server.dirty_blocks) == [0, 2, 3, 4, 5, 6, 7, 8]
+        assert server.read(BLOCK_SIZE * 2, len(data)) == data
+        server.flush()
+        assert self.durable.read_block("dev1", 8) == data[-BLOCK_SIZE:]
+
+    def test_partial_write_to_resident_block_is_stored_in_place(self):
+        volatile = FileStorage(self.volatile_path, total_size_bytes=BLOCK_SIZE * 10, reserve=True)
+        server = self.make_server(10, volatile=volatile)
+        server.write(BLOCK_SIZE, b"\x01" * BLOCK_SIZE)
+
+        with mock.patch.object(volatile, "read_blocks", wraps=volatile.read_blocks) as read_blocks, \
+                mock.patch.object(volatile, "write_block", wraps=volatile.write_block) as write_block:
+            server.write(BLOCK_SIZE + 100, b"abc")
+
+        # Stored in place, without a read-modify-write.
+        read_blocks.assert_not_called()
+        write_block.assert_not_called()
+        assert server.read(BLOCK_SIZE + 99, 5) == b"\x01abc\x01"
+        assert 1 in server.dirty_blocks
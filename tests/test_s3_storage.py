@@ -1,9 +1,9 @@
+import os
+
 import boto3
 import pytest
 
-from botocore.exceptions import ClientError
-
-from nbd_server.s3_storage import S3Storage
+from nbd_server.s3_storage import MAX_POOL_CONNECTIONS, S3Storage
 from nbd_server.util import BLOCK_SIZE
 
 
@@ -12,38 +12,53 @@ EXPORT = "dev1"
 
 
 @pytest.fixture(scope="module")
-def s3_client():
-    """Return a low-level boto3 client connected to MinIO."""
+def s3_client(s3_endpoint):
+    """Return a low-level boto3 client connected to the test S3 endpoint."""
     return boto3.client(
         "s3",
-        endpoint_url="http://localhost:9000",
+        endpoint_url=s3_endpoint,
         aws_access_key_id="minioadmin",
         aws_secret_access_key="minioadmin",
         region_name="us-east-1",
     )
 
 
-@pytest.fixture(scope="module", autouse=True)
-def ensure_bucket(s3_client):
-    """Ensure the test bucket exists."""
-    # Try to create bucket
-    try:
-        s3_client.create_bucket(Bucket=BUCKET)
-    except ClientError as e:
-        code = e.response["Error"]["Code"]
-        if code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
-            raise
+@pytest.fixture
+def packed_storage(s3_endpoint):
+    """Return an S3Storage backend that packs 4 blocks per object."""
+    return S3Storage(
+        bucket=BUCKET,
+        export_name="packed",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+        pack_size=4,
+    )
 
 
 @pytest.fixture
-def storage():
+def storage(s3_endpoint):
     """Return an S3Storage backend."""
     return S3Storage(
         bucket=BUCKET,
         export_name=EXPORT,
-        endpoint_url="http://localhost:9000",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+    )
+
+
+@pytest.fixture
+def compressed_storage(s3_endpoint):
+    """Return an S3Storage backend that LZ4-compresses block objects."""
+    pytest.importorskip("lz4")
+    return S3Storage(
+        bucket=BUCKET,
+        export_name=EXPORT,
+        endpoint_url=s3_endpoint,
         aws_access_key_id="minioadmin",
         aws_secret_access_key="minioadmin",
+        compress=True,
     )
 
 
@@ -66,20 +81,74 @@ def test_write_and_read_roundtrip(storage):
 
 def test_atomic_write(storage, s3_client):
     block_id = 7
-    tmp_key = f"exports/{EXPORT}/blocks/{block_id}.tmp"
     real_key = f"exports/{EXPORT}/blocks/{block_id}"
 
     write_data = b"A" + bytes(BLOCK_SIZE - 1)
     storage.write_block(EXPORT, block_id, write_data)
 
-    # temp file must NOT exist
-    with pytest.raises(ClientError):
-        s3_client.get_object(Bucket=BUCKET, Key=tmp_key)
+    # The block is written directly to its key: no temporary object exists
+    listed = s3_client.list_objects_v2(Bucket=BUCKET, Prefix=real_key)
+    assert [obj["Key"] for obj in listed["Contents"]] == [real_key]
 
     # real key must exist
     resp = s3_client.get_object(Bucket=BUCKET, Key=real_key)
-    body = resp["Body"].read()
-    assert body == write_data
+    assert resp["Body"].read() == write_data
+
+
+def test_blocks_are_stored_raw_by_default(storage, s3_client):
+    block_id = 18
+    write_data = b"hello" + bytes(BLOCK_SIZE - 5)
+    storage.write_block(EXPORT, block_id, write_data)
+
+    resp = s3_client.get_object(Bucket=BUCKET, Key=f"exports/{EXPORT}/blocks/{block_id}")
+    assert resp["Metadata"] == {}
+    assert resp["Body"].read() == write_data
+
+
+def test_compressible_block_is_stored_compressed(compressed_storage, storage, s3_client):
+    block_id = 19
+    write_data = b"hello" + bytes(BLOCK_SIZE - 5)
+    compressed_storage.write_block(EXPORT, block_id, write_data)
+
+    resp = s3_client.get_object(Bucket=BUCKET, Key=f"exports/{EXPORT}/blocks/{block_id}")
+    assert resp["Metadata"] == {"compressed": "lz4"}
+    assert len(resp["Body"].read()) < 100
+    assert compressed_storage.read_block(EXPORT, block_id) == write_data
+    # Readers decompress regardless of their own compress setting.
+    assert storage.read_block(EXPORT, block_id) == write_data
+
+
+def test_incompressible_block_is_stored_raw(compressed_storage, s3_client):
+    block_id = 40
+    write_data = os.urandom(BLOCK_SIZE)
+    compressed_storage.write_block(EXPORT, block_id, write_data)
+
+    resp = s3_client.get_object(Bucket=BUCKET, Key=f"exports/{EXPORT}/blocks/{block_id}")
+    assert resp["Metadata"] == {}
+    assert resp["Body"].read() == write_data
+    assert compressed_storage.read_block(EXPORT, block_id) == write_data
+
+
+def test_compress_without_lz4_is_rejected(s3_endpoint, monkeypatch):
+    monkeypatch.setattr("nbd_server.s3_storage.lz4_block", None)
+    with pytest.raises(RuntimeError, match="lz4"):
+        S3Storage(bucket=BUCKET, export_name=EXPORT, endpoint_url=s3_endpoint, compress=True)
+
+
+def test_compress_with_pack_size_is_rejected(s3_endpoint):
+    with pytest.raises(ValueError):
+        S3Storage(
+            bucket=BUCKET, export_name=EXPORT, endpoint_url=s3_endpoint,
+            pack_size=4, compress=True,
+        )
+
+
+def test_max_workers_above_pool_size_is_rejected(s3_endpoint):
+    with pytest.raises(ValueError):
+        S3Storage(
+            bucket=BUCKET, export_name=EXPORT, endpoint_url=s3_endpoint,
+            max_workers=MAX_POOL_CONNECTIONS + 1,
+        )
 
 
 def test_normalizes_short_blocks(storage, s3_client):
@@ -92,4 +161,140 @@ def test_normalizes_short_blocks(storage, s3_client):
     out = storage.read_block(EXPORT, block_id)
     assert out.startswith(b"XYZ")
     assert out[3:] == bytes(BLOCK_SIZE - 3)
-    assert len(out) == BLOCK_SIZE
\ No newline at end of file
+    assert len(out) == BLOCK_SIZE
+
+
+def test_write_blocks_and_read_blocks_roundtrip(storage):
+    items = [(block_id, bytes([block_id]) * BLOCK_SIZE) for block_id in range(20, 36)]
+
+    storage.write_blocks(EXPORT, items)
+    out = storage.read_blocks(EXPORT, [block_id for block_id, _ in items])
+
+    assert out == [data for _, data in items]
+
+
+def test_packed_write_and_read_range(packed_storage, s3_client):
+    items = [(block_id, bytes([block_id + 1]) * BLOCK_SIZE) for block_id in range(2, 7)]
+    packed_storage.write_blocks("packed", items)
+
+    # Blocks 2..6 span stripes 0 and 1.
+    assert packed_storage.read_range("packed", 2, 3) == [data for _, data in items[:2]]
+    assert packed_storage.read_blocks("packed", list(range(0, 8))) == (
+        [bytes(BLOCK_SIZE)] * 2 + [data for _, data in items] + [bytes(BLOCK_SIZE)]
+    )
+
+    resp = s3_client.get_object(Bucket=BUCKET, Key="exports/packed/stripes/1")
+    assert len(resp["Body"].read()) == 4 * BLOCK_SIZE
+
+
+def test_packed_write_block_preserves_neighbours(packed_storage):
+    packed_storage.write_block("packed", 8, b"P" * BLOCK_SIZE)
+    packed_storage.write_block("packed", 9, b"Q" * BLOCK_SIZE)
+
+    assert packed_storage.read_block("packed", 8) == b"P" * BLOCK_SIZE
+    assert packed_storage.read_block("packed", 9) == b"Q" * BLOCK_SIZE
+    assert packed_storage.read_block("packed", 10) == bytes(BLOCK_SIZE)
+
+
+def test_list_blocks(storage, packed_storage):
+    storage.write_block(EXPORT, 11, b"L" * BLOCK_SIZE)
+    assert 11 in storage.list_blocks(EXPORT)
+
+    packed_storage.write_block("packed", 13, b"L" * BLOCK_SIZE)
+    assert {12, 13, 14, 15} <= set(packed_storage.list_blocks("packed"))
+
+
+def test_client_shared_across_exports(storage, packed_storage):
+    assert storage.s3 is packed_storage.s3
+    assert storage.s3.meta.config.max_pool_connections >= 32
+
+
+def test_write_block_accepts_bytes_like(storage):
+    storage.write_block(EXPORT, 17, bytearray(b"B" * BLOCK_SIZE))
+    storage.write_block(EXPORT, 18, memoryview(b"M" * BLOCK_SIZE))
+
+    assert storage.read_block(EXPORT, 17) == b"B" * BLOCK_SIZE
+    assert storage.read_block(EXPORT, 18) == b"M" * BLOCK_SIZE
+
+
+def test_large_stripe_uses_multipart_upload(s3_client, s3_endpoint):
+    # 2048 blocks * 4 KiB = 8 MiB per stripe → multipart upload.
+    storage = S3Storage(
+        bucket=BUCKET,
+        export_name="multipart",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+        pack_size=2048,
+    )
+    items = [(block_id, bytes([block_id % 251]) * BLOCK_SIZE) for block_id in range(2048)]
+    storage.write_blocks("multipart", items)
+
+    head = s3_client.head_object(Bucket=BUCKET, Key="exports/multipart/stripes/0")
+    assert head["ContentLength"] == 2048 * BLOCK_SIZE
+    assert head["ETag"].strip('"').endswith("-2")  # two parts
+
+    assert storage.read_blocks("multipart", [0, 1300, 2047]) == [
+        items[0][1], items[1300][1], items[2047][1]
+    ]
+
+
+def test_large_stripe_read_modify_write(s3_endpoint):
+    # Updating one block of an 8 MiB stripe reads the whole stripe back with
+    # concurrent sub-range GETs before uploading it again.
+    storage = S3Storage(
+        bucket=BUCKET,
+        export_name="multipart-rmw",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+        pack_size=2048,
+    )
+    items = [(block_id, bytes([block_id % 251]) * BLOCK_SIZE) for block_id in range(2048)]
+    storage.write_blocks("multipart-rmw", items)
+
+    storage.write_block("multipart-rmw", 1500, b"R" * BLOCK_SIZE)
+
+    assert storage.read_blocks("multipart-rmw", [0, 1280, 1499, 1500, 1501, 2047]) == [
+        items[0][1], items[1280][1], items[1499][1], b"R" * BLOCK_SIZE,
+        items[1501][1], items[2047][1],
+    ]
+    storage.close()
+
+
+def test_puts_carry_crc32c_checksums(s3_client, s3_endpoint, monkeypatch):
+    # Single PUTs and multipart stripes both ask S3 for a CRC32C checksum.
+    pytest.importorskip("awscrt")
+    monkeypatch.setattr("nbd_server.s3_storage._PUT_CHECKSUM_ARGS", {"ChecksumAlgorithm": "CRC32C"})
+
+    storage = S3Storage(
+        bucket=BUCKET,
+        export_name="checksum",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+    )
+    storage.write_block("checksum", 3, b"C" * BLOCK_SIZE)
+
+    head = s3_client.head_object(
+        Bucket=BUCKET, Key="exports/checksum/blocks/3", ChecksumMode="ENABLED",
+    )
+    assert "ChecksumCRC32C" in head
+
+    # 2048 blocks * 4 KiB = 8 MiB per stripe → multipart upload.
+    packed = S3Storage(
+        bucket=BUCKET,
+        export_name="checksum-multipart",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="minioadmin",
+        aws_secret_access_key="minioadmin",
+        pack_size=2048,
+    )
+    items = [(block_id, bytes([block_id % 251]) * BLOCK_SIZE) for block_id in range(2048)]
+    packed.write_blocks("checksum-multipart", items)
+
+    head = s3_client.head_object(
+        Bucket=BUCKET, Key="exports/checksum-multipart/stripes/0", ChecksumMode="ENABLED",
+    )
+    assert head["ETag"].strip('"').endswith("-2")  # two parts
+    assert "ChecksumCRC32C" in head
@@ -0,0 +1,90 @@
+from nbd_server.util import BlockBitmap
+
+
+def test_block_bitmap_iterates_in_ascending_order():
+    bitmap = BlockBitmap(200)
+    assert not bitmap
+    assert list(bitmap) == []
+
+    for block_id in (199, 0, 64, 63, 7, 64):
+        bitmap.add(block_id)
+
+    assert bitmap
+    assert len(bitmap) == 5
+    assert list(bitmap) == [0, 7, 63, 64, 199]
+
+
+def test_block_bitmap_removal():
+    bitmap = BlockBitmap(100)
+    bitmap.update([1, 2, 3, 50, 500])
+
+    bitmap.difference_update([2, 50])
+    assert list(bitmap) == [1, 3]
+
+    bitmap.clear()
+    assert len(bitmap) == 0
+    assert 1 not in bitmap
+
+
+def test_block_bitmap_contains_range():
+    bitmap = BlockBitmap(100)
+    bitmap.add_range(5, 70)
+
+    assert bitmap.contains_range(5, 70)
+    assert bitmap.contains_range(8, 64)   # whole bytes only
+    assert bitmap.contains_range(6, 9)    # within two bytes
+    assert not bitmap.contains_range(4, 70)
+    assert not bitmap.contains_range(5, 71)
+
+    bitmap.discard(40)
+    assert not bitmap.contains_range(5, 70)
+    assert bitmap.contains_range(41, 70)
+
+
+def test_block_bitmap_union_update():
+    bitmap = BlockBitmap(130)
+    bitmap.update([0, 129])
+    other = BlockBitmap(130)
+    other.update([0, 5, 64])
+
+    bitmap.union_update(other)
+    assert list(bitmap) == [0, 5, 64, 129]
+    assert list(other) == [0, 5, 64]
+
+
+def test_block_bitmap_union_update_across_chunks():
+    # `other` has a set bit in the partial last chunk only; chunks it leaves
+    # clear keep their bits.
+    num_blocks = 3 * 512 * 1024 + 5
+    bitmap = BlockBitmap(num_blocks)
+    bitmap.update([7, 600_000])
+    other = BlockBitmap(num_blocks)
+    other.update([num_blocks - 1])
+
+    bitmap.union_update(other)
+    assert list(bitmap) == [7, 600_000, num_blocks - 1]
+
+
+def test_block_bitmap_sparse_scan_across_chunks():
+    # Several 512 Ki-block scan chunks, the last one partial.
+    num_blocks = 3 * 512 * 1024 + 5
+    bitmap = BlockBitmap(num_blocks)
+    block_ids = [511, 512, 600_000, 1_048_575, 1_048_576, num_blocks - 1]
+    bitmap.update(block_ids)
+
+    assert list(bitmap) == block_ids
+    assert len(bitmap) == len(block_ids)
+    assert bitmap
+
+    bitmap.difference_update(block_ids)
+    assert not bitmap
+    assert list(bitmap) == []
+
+
+def test_block_bitmap_add_range():
+    bitmap = BlockBitmap(100)
+    bitmap.add_range(3, 5)
+    bitmap.add_range(6, 37)
+    bitmap.add_range(99, 100)
+
+    assert list(bitmap) == [3, 4] + list(range(6, 37)) + [99]